@@ -1,13 +1,38 @@
 import os
+import copy
 import uuid
+import time
+import math
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+import threading
+import multiprocessing
+from collections import deque, Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, HttpUrl
+from typing import List, Optional
+import pytube
+import pytube.extract
 from pytube import YouTube
+from pytube.cipher import Cipher
+from pytube.exceptions import ExtractError, VideoUnavailable
 import ffmpeg
 import re
-from urllib.parse import urlparse, parse_qs
+import json
+import glob
+import shutil
+import hashlib
+import errno
+import struct
+import sqlite3
+from email.utils import formatdate
+from urllib.parse import urlparse, parse_qs, quote
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -20,20 +45,843 @@ DOWNLOAD_DIR = "downloaded_videos"
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 RESOLUTIONS = ["2160p", "1080p", "720p", "480p"]
+RESOLUTION_SIZES = {"2160p": (3840, 2160), "1080p": (1920, 1080), "720p": (1280, 720), "480p": (854, 480)}
+
+# Worker pools: threads for network I/O, processes for CPU-bound transcodes
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "8"))
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", str(os.cpu_count() or 1)))
+
+# Transcode workers report ffmpeg progress back to the main process through this queue
+progress_queue = multiprocessing.Queue()
+worker_progress_queue = None
+
+def init_transcode_worker(queue):
+    global worker_progress_queue
+    worker_progress_queue = queue
+
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+transcode_executor = ProcessPoolExecutor(max_workers=TRANSCODE_WORKERS, initializer=init_transcode_worker,
+                                         initargs=(progress_queue,))
+
+# Segment-parallel encoding: long sources are cut at keyframes into SEGMENT_SECONDS pieces that are
+# encoded across the transcode pool and joined losslessly. 0 disables it.
+SEGMENT_SECONDS = int(os.environ.get("SEGMENT_SECONDS", "30"))
+SEGMENT_ENCODER_THREADS = max(1, (os.cpu_count() or 1) // TRANSCODE_WORKERS)
+
+# Range-chunked downloads: each stream is split into DOWNLOAD_CHUNK_SIZE byte ranges fetched
+# over DOWNLOAD_CONNECTIONS pooled connections
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "4"))
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", str(8 * 1024 * 1024)))
+CHUNK_RETRIES = int(os.environ.get("CHUNK_RETRIES", "3"))
+
+# Feed HTTP response bodies straight into ffmpeg through named pipes instead of writing the
+# source to disk first; sources that need a seekable input still go through a file
+STREAMING_MODE = os.environ.get("STREAMING_MODE", "1") == "1"
+
+# Progressive downloads: MP4 outputs are written as fragmented MP4, so GET /download can send
+# each fragment as soon as ffmpeg has written it instead of waiting for the job to finish
+PROGRESSIVE_DOWNLOADS = os.environ.get("PROGRESSIVE_DOWNLOADS", "1") == "1"
+PROGRESSIVE_POLL_INTERVAL = float(os.environ.get("PROGRESSIVE_POLL_INTERVAL", "0.5"))
+
+# Finished outputs are kept in a content-addressed cache keyed by video, resolution and encoder settings
+CACHE_DIR = os.environ.get("CACHE_DIR", "output_cache")
+os.makedirs(CACHE_DIR, exist_ok=True)
+CACHE_INDEX = os.path.join(CACHE_DIR, "index.json")
+
+# Disk budget for the output cache: once usage passes the high watermark, evict down to the low one
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(50 * 1024 ** 3)))
+CACHE_HIGH_WATERMARK = float(os.environ.get("CACHE_HIGH_WATERMARK", "0.9"))
+CACHE_LOW_WATERMARK = float(os.environ.get("CACHE_LOW_WATERMARK", "0.75"))
+CACHE_EVICTION_POLICY = os.environ.get("CACHE_EVICTION_POLICY", "lru")  # "lru" or "lfu"
+
+# Encoder profiles: x264 preset and CRF per output resolution, overridable per request
+ENCODER_PROFILES = {
+    "2160p": {"vcodec": "libx264", "preset": "fast", "crf": 22},
+    "1080p": {"vcodec": "libx264", "preset": "medium", "crf": 21},
+    "720p": {"vcodec": "libx264", "preset": "medium", "crf": 21},
+    "480p": {"vcodec": "libx264", "preset": "slow", "crf": 22},
+}
+AUDIO_BITRATE = "160k"
+
+# Audio-only formats: (preferred source subtype, codec that can be copied as-is, encoder otherwise, extension)
+AUDIO_FORMATS = {
+    "m4a": ("mp4", "aac", "aac", ".m4a"),
+    "opus": ("webm", "opus", "libopus", ".opus"),
+    "mp3": ("mp4", "mp3", "libmp3lame", ".mp3"),
+}
+MEDIA_TYPES = {".mp4": "video/mp4", ".m4a": "audio/mp4", ".opus": "audio/ogg", ".mp3": "audio/mpeg",
+               ".m3u8": "application/vnd.apple.mpegurl", ".mpd": "application/dash+xml", ".m4s": "video/iso.segment"}
+# Streaming packages: the ladder renditions are stream-copied into HLS or DASH segments of about
+# PACKAGE_SEGMENT_SECONDS, and the format maps to the name of its top-level manifest
+PACKAGE_FORMATS = {"hls": "master.m3u8", "dash": "manifest.mpd"}
+PACKAGE_SEGMENT_SECONDS = int(os.environ.get("PACKAGE_SEGMENT_SECONDS", "6"))
+X264_PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+# When the job queue is at least this full, new jobs without a preset override use a faster preset
+LOAD_PRESET_STEPS = sorted(
+    ((float(fill), preset) for fill, preset in
+     (step.split(":") for step in os.environ.get("LOAD_PRESET_STEPS", "0.5:veryfast,0.8:ultrafast").split(","))),
+    reverse=True)
+
+# Task store backend: "sqlite" keeps tasks, the job journal, the output cache index and in-flight
+# job state in TASK_DB, shared by all uvicorn workers; "memory" keeps them in the one process
+TASK_STORE = os.environ.get("TASK_STORE", "sqlite")
+TASK_DB = os.environ.get("TASK_DB", "tasks.db")
+TASK_FLUSH_INTERVAL = float(os.environ.get("TASK_FLUSH_INTERVAL", "0.5"))
+
+# Workers sharing TASK_DB heartbeat on every flush; one that is silent for WORKER_TIMEOUT seconds is
+# presumed dead, and its journaled jobs are picked up by the others within JOB_RECOVERY_INTERVAL
+WORKER_TIMEOUT = float(os.environ.get("WORKER_TIMEOUT", "30"))
+JOB_RECOVERY_INTERVAL = float(os.environ.get("JOB_RECOVERY_INTERVAL", "10"))
+
+# Push updates: watched tasks are checked for changes every EVENT_PUSH_INTERVAL seconds
+EVENT_PUSH_INTERVAL = float(os.environ.get("EVENT_PUSH_INTERVAL", "0.25"))
+EVENT_KEEPALIVE = 15  # seconds between SSE keepalive comments
+
+# Jobs that have not finished yet are journaled so a restarted process picks them up again; the
+# memory task store keeps its journal in this file
+JOB_JOURNAL = os.environ.get("JOB_JOURNAL", "pending_jobs.json")
+
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_connections=DOWNLOAD_WORKERS,
+                                           pool_maxsize=DOWNLOAD_WORKERS * DOWNLOAD_CONNECTIONS))
+http_session.mount("http://", HTTPAdapter(pool_connections=DOWNLOAD_WORKERS,
+                                          pool_maxsize=DOWNLOAD_WORKERS * DOWNLOAD_CONNECTIONS))
+
+# Admission control: at most MAX_CONCURRENT_JOBS run at once, MAX_QUEUE_DEPTH more may wait
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "2"))
+MAX_QUEUE_DEPTH = int(os.environ.get("MAX_QUEUE_DEPTH", "50"))
+DEFAULT_JOB_DURATION = 60  # seconds, used for Retry-After until real durations are known
+
+# Video metadata cache: resolved titles and stream lists are reused for up to METADATA_TTL seconds,
+# but never past METADATA_EXPIRY_MARGIN before the earliest signed stream URL expires
+METADATA_TTL = int(os.environ.get("METADATA_TTL", "3600"))
+METADATA_NEGATIVE_TTL = int(os.environ.get("METADATA_NEGATIVE_TTL", "300"))  # for unavailable videos
+METADATA_EXPIRY_MARGIN = int(os.environ.get("METADATA_EXPIRY_MARGIN", "600"))
+
+# Player cache: YouTube player scripts and their parsed signature transforms, kept per player version
+PLAYER_CACHE_DIR = os.environ.get("PLAYER_CACHE_DIR", "player_cache")
+os.makedirs(PLAYER_CACHE_DIR, exist_ok=True)
+
+# Stream selection policy: codecs earlier in the list win ties at the same resolution
+CODEC_PREFERENCE = os.environ.get("CODEC_PREFERENCE", "avc1,vp9,av01").split(",")
+MAX_FPS = int(os.environ.get("MAX_FPS", "60"))
 
 # Models
 class DownloadRequest(BaseModel):
     url: HttpUrl
-    resolution: str
+    resolution: Optional[str] = None  # required unless audio_format is set
+    codec: Optional[str] = None
+    max_fps: Optional[int] = None
+    video_only: bool = False
+    resolutions: Optional[List[str]] = None  # extra renditions encoded from the same decode as `resolution`
+    preset: Optional[str] = None
+    crf: Optional[int] = None
+    audio_format: Optional[str] = None  # audio-only download, one of AUDIO_FORMATS
+    audio_bitrate: Optional[int] = None  # kbps; picks the closest source stream and the encode bitrate
+    start: Optional[float] = None  # clip start in seconds
+    end: Optional[float] = None  # clip end in seconds
+    output_format: Optional[str] = None  # "mp4" (default), or "hls"/"dash" to also package the renditions for streaming
 
 class DownloadStatus(BaseModel):
     task_id: str
     status: str
-    filename: str = None
-    error: str = None
+    video_id: Optional[str] = None
+    filename: Optional[str] = None
+    error: Optional[str] = None
+    queue_position: Optional[int] = None
+    selected_stream: Optional[dict] = None
+    processing_mode: Optional[str] = None
+    cache_key: Optional[str] = None
+    renditions: Optional[dict] = None
+    package: Optional[dict] = None
+    encoder_profile: Optional[dict] = None
+    subscribers: Optional[int] = None
+    downloaded_bytes: Optional[int] = None
+    total_bytes: Optional[int] = None
+    duration: Optional[int] = None
+    transcode_percent: Optional[float] = None
+    encode_fps: Optional[float] = None
+    encode_speed: Optional[float] = None
+    eta_seconds: Optional[float] = None
+
+# Task storage
+TERMINAL_STATUSES = {"Completed", "Failed"}
+
+class MemoryTaskStore:
+    """Process-local task store. Task objects are mutated in place by the job that owns them.
+
+    Besides tasks it holds the job state that identical requests and restarts depend on: the journal
+    of unfinished jobs (saved to JOB_JOURNAL), the in-flight job of each job key, and the outputs
+    of jobs that can be served while they are still being encoded.
+    """
+    
+    def __init__(self):
+        self.tasks = {}
+        self.aliases = {}
+        self.jobs = {}  # task_id -> journaled request
+        self.journal_claimed = False
+        self.inflight = {}  # job key -> task_id of the job doing the work
+        self.live = {}  # primary cache_key -> {"task_id", "resolution", "outputs": {resolution: [path, filename]}}
+    
+    def add(self, task: DownloadStatus):
+        self.tasks[task.task_id] = task
+    
+    def add_alias(self, alias_id: str, primary_id: str):
+        # Returns the number of tasks now following the primary, itself included
+        self.tasks.pop(alias_id, None)
+        self.aliases[alias_id] = primary_id
+        primary = self.get(primary_id)
+        primary.subscribers = (primary.subscribers or 1) + 1
+        return primary.subscribers
+    
+    def get(self, task_id: str):
+        primary_id = self.aliases.get(task_id)
+        if primary_id is None:
+            return self.tasks.get(task_id)
+        primary = self.get(primary_id)
+        return primary.model_copy(update={"task_id": task_id}) if primary else None
+    
+    def find_by_video_id(self, video_id: str, limit: int = 100):
+        # Most recent first
+        return [task for task in reversed(self.tasks.values()) if task.video_id == video_id][:limit]
+    
+    def journal_job(self, task_id: str, request: dict):
+        self.jobs[task_id] = request
+        write_json_atomic(JOB_JOURNAL, self.jobs)
+    
+    def finish_job(self, task_id: str):
+        if self.jobs.pop(task_id, None) is not None:
+            write_json_atomic(JOB_JOURNAL, self.jobs)
+    
+    def claim_orphaned_jobs(self):
+        # Only this process writes the journal file, so whatever it holds at startup is orphaned
+        if self.journal_claimed:
+            return {}
+        self.journal_claimed = True
+        if not os.path.exists(JOB_JOURNAL):
+            return {}
+        with open(JOB_JOURNAL) as f:
+            journal = json.load(f)
+        self.jobs.update(journal)
+        return journal
+    
+    def journaled_task_ids(self):
+        return set(self.jobs)
+    
+    def claim_inflight(self, job_key: str, task_id: str):
+        # Returns the task_id of the job that now holds the key: task_id itself if it was free
+        return self.inflight.setdefault(job_key, task_id)
+    
+    def inflight_task(self, job_key: str):
+        return self.inflight.get(job_key)
+    
+    def release_inflight(self, job_key: str, task_id: str):
+        if self.inflight.get(job_key) == task_id:
+            del self.inflight[job_key]
+    
+    def set_live_outputs(self, cache_key: str, live: dict):
+        self.live[cache_key] = live
+    
+    def live_outputs(self, cache_key: str):
+        return self.live.get(cache_key)
+    
+    def clear_live_outputs(self, cache_key: str, task_id: str):
+        if self.live.get(cache_key, {}).get("task_id") == task_id:
+            del self.live[cache_key]
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        pass
+
+class SQLiteTaskStore(MemoryTaskStore):
+    """SQLite-backed task store, shared by every worker process that opens the same database.
+
+    Tasks of running jobs stay in memory so the job can keep mutating them; flush() writes
+    all of them to the database in one transaction and drops the ones that have finished.
+    Lookups fall through to the database, so any worker process can answer /status.
+    
+    The job journal, in-flight jobs and live outputs are rows owned by the worker that wrote them.
+    Each worker heartbeats on flush; rows of a worker that stopped heartbeating are ignored, and its
+    journaled jobs can be claimed by another worker.
+    """
+    
+    def __init__(self, path: str):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.owner = uuid.uuid4().hex
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            video_id TEXT,
+            alias_of TEXT,
+            status TEXT NOT NULL,
+            updated REAL NOT NULL,
+            data TEXT
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_video_id ON tasks (video_id, updated)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_alias_of ON tasks (alias_of)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            task_id TEXT PRIMARY KEY,
+            request TEXT NOT NULL,
+            owner TEXT
+        )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS inflight (
+            job_key TEXT PRIMARY KEY,
+            task_id TEXT NOT NULL,
+            owner TEXT NOT NULL
+        )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS live_outputs (
+            cache_key TEXT PRIMARY KEY,
+            task_id TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            data TEXT NOT NULL
+        )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS workers (
+            owner TEXT PRIMARY KEY,
+            heartbeat REAL NOT NULL
+        )""")
+        self.heartbeat()
+    
+    def heartbeat(self):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO workers (owner, heartbeat) VALUES (?, ?)", (self.owner, time.time()))
+            self.db.execute("DELETE FROM workers WHERE heartbeat < ?", (time.time() - 10 * WORKER_TIMEOUT,))
+    
+    def live_owners(self):
+        # SQL for the owners that are still heartbeating, with its parameter
+        return "SELECT owner FROM workers WHERE heartbeat > ?", time.time() - WORKER_TIMEOUT
+    
+    def add_alias(self, alias_id: str, primary_id: str):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO tasks (task_id, alias_of, status, updated) VALUES (?, ?, ?, ?)",
+                            (alias_id, primary_id, "Alias", time.time()))
+            aliases, = self.db.execute("SELECT COUNT(*) FROM tasks WHERE alias_of = ?", (primary_id,)).fetchone()
+        self.tasks.pop(alias_id, None)
+        primary = self.tasks.get(primary_id)
+        if primary:
+            primary.subscribers = aliases + 1
+        return aliases + 1
+    
+    def get(self, task_id: str):
+        task = self.tasks.get(task_id)
+        if task:
+            return task
+        with self.lock:
+            row = self.db.execute("SELECT alias_of, data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        alias_of, data = row
+        if alias_of:
+            primary = self.get(alias_of)
+            return primary.model_copy(update={"task_id": task_id}) if primary else None
+        return DownloadStatus.model_validate_json(data)
+    
+    def find_by_video_id(self, video_id: str, limit: int = 100):
+        with self.lock:
+            rows = self.db.execute("SELECT task_id, data FROM tasks WHERE video_id = ? AND alias_of IS NULL "
+                                   "ORDER BY updated DESC LIMIT ?", (video_id, limit)).fetchall()
+        # Tasks of running jobs are fresher in memory, and may not have been written yet
+        hot = [task for task in reversed(self.tasks.values()) if task.video_id == video_id]
+        hot_ids = {task.task_id for task in hot}
+        stored = [DownloadStatus.model_validate_json(data) for task_id, data in rows if task_id not in hot_ids]
+        return (hot + stored)[:limit]
+    
+    def journal_job(self, task_id: str, request: dict):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO jobs (task_id, request, owner) VALUES (?, ?, ?)",
+                            (task_id, json.dumps(request), self.owner))
+    
+    def finish_job(self, task_id: str):
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE task_id = ?", (task_id,))
+    
+    def claim_orphaned_jobs(self):
+        # Takes over the journaled jobs of workers that shut down or stopped heartbeating
+        owners, since = self.live_owners()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.db.execute(f"SELECT task_id, request FROM jobs WHERE owner IS NULL OR owner NOT IN ({owners})",
+                                       (since,)).fetchall()
+                self.db.executemany("UPDATE jobs SET owner = ? WHERE task_id = ?",
+                                    [(self.owner, task_id) for task_id, _ in rows])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return {task_id: json.loads(request) for task_id, request in rows}
+    
+    def journaled_task_ids(self):
+        with self.lock:
+            return {task_id for task_id, in self.db.execute("SELECT task_id FROM jobs")}
+    
+    def claim_inflight(self, job_key: str, task_id: str):
+        owners, since = self.live_owners()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute(f"SELECT task_id FROM inflight WHERE job_key = ? AND owner IN ({owners})",
+                                      (job_key, since)).fetchone()
+                if row is None:
+                    self.db.execute("INSERT OR REPLACE INTO inflight (job_key, task_id, owner) VALUES (?, ?, ?)",
+                                    (job_key, task_id, self.owner))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return row[0] if row else task_id
+    
+    def inflight_task(self, job_key: str):
+        owners, since = self.live_owners()
+        with self.lock:
+            row = self.db.execute(f"SELECT task_id FROM inflight WHERE job_key = ? AND owner IN ({owners})",
+                                  (job_key, since)).fetchone()
+        return row[0] if row else None
+    
+    def release_inflight(self, job_key: str, task_id: str):
+        with self.lock:
+            self.db.execute("DELETE FROM inflight WHERE job_key = ? AND task_id = ?", (job_key, task_id))
+    
+    def set_live_outputs(self, cache_key: str, live: dict):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO live_outputs (cache_key, task_id, owner, data) VALUES (?, ?, ?, ?)",
+                            (cache_key, live["task_id"], self.owner, json.dumps(live)))
+    
+    def live_outputs(self, cache_key: str):
+        owners, since = self.live_owners()
+        with self.lock:
+            row = self.db.execute(f"SELECT data FROM live_outputs WHERE cache_key = ? AND owner IN ({owners})",
+                                  (cache_key, since)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def clear_live_outputs(self, cache_key: str, task_id: str):
+        # Followers on other workers take a missing row to mean the job is done, so the row goes in
+        # the flush that writes the task's terminal state; see flush()
+        if task_id not in self.tasks:
+            with self.lock:
+                self.db.execute("DELETE FROM live_outputs WHERE cache_key = ? AND task_id = ?", (cache_key, task_id))
+    
+    def flush(self):
+        self.heartbeat()
+        tasks = list(self.tasks.values())
+        if not tasks:
+            return
+        now = time.time()
+        with self.lock:
+            # Aliases may have been added by other workers since the primary was last written
+            primaries = [task for task in tasks if task.subscribers is not None]
+            if primaries:
+                placeholders = ",".join("?" * len(primaries))
+                counts = dict(self.db.execute(
+                    f"SELECT alias_of, COUNT(*) FROM tasks WHERE alias_of IN ({placeholders}) GROUP BY alias_of",
+                    [task.task_id for task in primaries]).fetchall())
+                for task in primaries:
+                    task.subscribers = counts.get(task.task_id, 0) + 1
+            rows = [(task.task_id, task.video_id, task.status, now, task.model_dump_json()) for task in tasks]
+            finished = [(task_id,) for task_id, _, status, _, _ in rows if status in TERMINAL_STATUSES]
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO tasks (task_id, video_id, status, updated, data) "
+                                "VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.executemany("DELETE FROM live_outputs WHERE task_id = ?", finished)
+            self.db.execute("COMMIT")
+        # Only drop tasks whose terminal state is what was just written
+        for task_id, in finished:
+            self.tasks.pop(task_id, None)
+    
+    def close(self):
+        self.flush()
+        with self.lock:
+            # Hand unfinished jobs back right away instead of after WORKER_TIMEOUT
+            self.db.execute("UPDATE jobs SET owner = NULL WHERE owner = ?", (self.owner,))
+            self.db.execute("DELETE FROM inflight WHERE owner = ?", (self.owner,))
+            self.db.execute("DELETE FROM live_outputs WHERE owner = ?", (self.owner,))
+            self.db.execute("DELETE FROM workers WHERE owner = ?", (self.owner,))
+            self.db.close()
+
+task_store = SQLiteTaskStore(TASK_DB) if TASK_STORE == "sqlite" else MemoryTaskStore()
+
+# Job queue state
+job_queue = asyncio.Queue(maxsize=MAX_QUEUE_DEPTH)
+queued_task_ids = deque()
+recent_job_durations = deque(maxlen=20)
+job_workers = []
+
+class TaskEventHub:
+    """Fans task state changes out to SSE and WebSocket watchers.
+
+    One pump serializes each watched task once per change and hands the same payload to
+    every watcher, so the per-watcher cost is a queue put.
+    """
+    
+    def __init__(self):
+        self.watchers = defaultdict(set)
+        self.last_payload = {}
+    
+    def subscribe(self, task_id: str):
+        queue = asyncio.Queue(maxsize=16)
+        self.watchers[task_id].add(queue)
+        self.last_payload.pop(task_id, None)  # make sure the new watcher gets the current state
+        return queue
+    
+    def unsubscribe(self, task_id: str, queue):
+        watchers = self.watchers.get(task_id)
+        if watchers is None:
+            return
+        watchers.discard(queue)
+        if not watchers:
+            del self.watchers[task_id]
+            self.last_payload.pop(task_id, None)
+    
+    def publish_changes(self):
+        for task_id, queues in list(self.watchers.items()):
+            task = task_store.get(task_id)
+            if task is None:
+                continue
+            payload = task.model_dump_json()
+            if payload == self.last_payload.get(task_id):
+                continue
+            self.last_payload[task_id] = payload
+            event = (task.status, payload)
+            for queue in queues:
+                if queue.full():
+                    # A slow watcher only needs the latest state, drop the stale one
+                    queue.get_nowait()
+                queue.put_nowait(event)
+
+task_events = TaskEventHub()
+
+# Output cache index: cache_key -> {"filename", "size", "package", "created", "last_access", "hits"}
+class CacheIndex:
+    """Process-local index of the output cache, saved to CACHE_INDEX on flush()."""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+    
+    def get(self, cache_key: str):
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            return dict(entry) if entry else None
+    
+    def put(self, cache_key: str, entry: dict):
+        with self.lock:
+            self.entries[cache_key] = entry
+    
+    def touch(self, cache_key: str, hit: bool = True):
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry:
+                entry["last_access"] = time.time()
+                entry["hits"] = entry.get("hits", 0) + hit
+    
+    def remove(self, cache_key: str):
+        # True if this call removed the entry, so only one caller deletes its files
+        with self.lock:
+            return self.entries.pop(cache_key, None) is not None
+    
+    def items(self):
+        with self.lock:
+            return [(cache_key, dict(entry)) for cache_key, entry in self.entries.items()]
+    
+    def usage(self):
+        # (entries, bytes)
+        with self.lock:
+            return len(self.entries), sum(entry["size"] for entry in self.entries.values())
+    
+    def flush(self):
+        with self.lock:
+            write_json_atomic(self.path, self.entries)
+
+class SQLiteCacheIndex(CacheIndex):
+    """Output cache index kept in the task database, so all worker processes share one cache.
+
+    Every change is written straight through; an existing CACHE_INDEX file is imported once.
+    """
+    
+    COLUMNS = ("filename", "size", "package", "created", "last_access", "hits")
+    
+    def __init__(self, path: str, legacy_index: str = None):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS output_cache (
+            cache_key TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            package TEXT,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL,
+            hits INTEGER NOT NULL
+        )""")
+        if legacy_index:
+            # Workers starting together may all get here; the import is idempotent and the rename best effort
+            try:
+                with open(legacy_index) as f:
+                    legacy = json.load(f)
+                for cache_key, entry in legacy.items():
+                    self.put(cache_key, entry, replace=False)
+                os.replace(legacy_index, f"{legacy_index}.imported")
+            except FileNotFoundError:
+                pass
+    
+    def row_entry(self, row):
+        entry = dict(zip(self.COLUMNS, row))
+        if entry["package"] is None:
+            del entry["package"]
+        return entry
+    
+    def get(self, cache_key: str):
+        with self.lock:
+            row = self.db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM output_cache WHERE cache_key = ?",
+                                  (cache_key,)).fetchone()
+        return self.row_entry(row) if row else None
+    
+    def put(self, cache_key: str, entry: dict, replace: bool = True):
+        values = (entry["filename"], entry["size"], entry.get("package"), entry["created"],
+                  entry.get("last_access", entry["created"]), entry.get("hits", 0))
+        with self.lock:
+            self.db.execute(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO output_cache "
+                            f"(cache_key, {', '.join(self.COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (cache_key, *values))
+    
+    def touch(self, cache_key: str, hit: bool = True):
+        with self.lock:
+            self.db.execute("UPDATE output_cache SET last_access = ?, hits = hits + ? WHERE cache_key = ?",
+                            (time.time(), int(hit), cache_key))
+    
+    def remove(self, cache_key: str):
+        with self.lock:
+            return self.db.execute("DELETE FROM output_cache WHERE cache_key = ?", (cache_key,)).rowcount == 1
+    
+    def items(self):
+        with self.lock:
+            rows = self.db.execute(f"SELECT cache_key, {', '.join(self.COLUMNS)} FROM output_cache").fetchall()
+        return [(row[0], self.row_entry(row[1:])) for row in rows]
+    
+    def usage(self):
+        with self.lock:
+            return tuple(self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM output_cache").fetchone())
+    
+    def flush(self):
+        pass
+
+output_cache = SQLiteCacheIndex(TASK_DB, CACHE_INDEX) if TASK_STORE == "sqlite" else CacheIndex(CACHE_INDEX)
+cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "evicted_bytes": 0}
+serving_counts = Counter()
+
+class PlayerCache:
+    """Disk-backed cache of YouTube player scripts and their signature transform plans.
+
+    Scripts are stored per player version, so resolving a new video fetches only its watch page
+    while the player stays the same. A plan is the parsed state of a pytube Cipher; every use gets
+    a fresh copy because deciphering the n parameter mutates it.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.scripts = {}  # version -> script
+        self.versions = {}  # sha256 of script -> version
+        self.plans = {}  # version -> Cipher template
+        self.stats = Counter()
+    
+    def script(self, js_url: str):
+        match = re.search(r"/s/player/([\w-]+)/", js_url)
+        version = match.group(1) if match else hashlib.sha256(js_url.encode()).hexdigest()[:16]
+        with self.lock:
+            script = self.scripts.get(version)
+        if script is not None:
+            self.stats["hits"] += 1
+            return script
+        
+        script_file = os.path.join(self.directory, f"{version}.js")
+        try:
+            with open(script_file) as f:
+                script = f.read()
+            self.stats["disk_hits"] += 1
+        except FileNotFoundError:
+            response = http_session.get(js_url, timeout=30)
+            response.raise_for_status()
+            script = response.text
+            with open(f"{script_file}.tmp", "w") as f:
+                f.write(script)
+            os.replace(f"{script_file}.tmp", script_file)
+            self.stats["fetches"] += 1
+            logger.info(f"Fetched player {version}")
+        with self.lock:
+            self.scripts[version] = script
+            self.versions[hashlib.sha256(script.encode()).hexdigest()] = version
+        return script
+    
+    def cipher(self, js: str):
+        # Stands in for pytube's Cipher constructor
+        version = self.versions.get(hashlib.sha256(js.encode()).hexdigest())
+        if version is None:
+            # pytube fetched this script itself, after a cached one failed
+            return Cipher(js=js)
+        with self.lock:
+            template = self.plans.get(version)
+        if template is None:
+            template = self.load_plan(version)
+            if template is None:
+                try:
+                    template = Cipher(js=js)
+                except ExtractError:
+                    logger.warning(f"Cached player {version} could not be parsed, dropping it")
+                    self.forget(version)
+                    raise
+                try:
+                    self.save_plan(version, template)
+                except (OSError, TypeError, ValueError) as e:
+                    logger.warning(f"Could not persist the plan for player {version}: {str(e)}")
+                self.stats["plan_builds"] += 1
+            with self.lock:
+                self.plans[version] = template
+        
+        # pytube fills the null slots of the throttling array with the array itself, and those
+        # slots have to point at the copy for calculate_n to leave the template alone
+        cipher = copy.copy(template)
+        cipher.throttling_array = []
+        cipher.throttling_array.extend(cipher.throttling_array if item is template.throttling_array else item
+                                       for item in template.throttling_array)
+        cipher.calculated_n = None
+        return cipher
+    
+    def save_plan(self, version: str, cipher: Cipher):
+        # Transform functions are module-level pytube.cipher functions and are stored by name;
+        # a list that contains itself stores those slots as {"self": true}
+        def encode(value):
+            if callable(value):
+                return {"function": value.__name__}
+            if isinstance(value, (list, tuple)):
+                return [{"self": True} if item is value else encode(item) for item in value]
+            if isinstance(value, dict):
+                return {key: encode(item) for key, item in value.items()}
+            return value
+        
+        plan = {name: encode(value) for name, value in vars(cipher).items() if name != "calculated_n"}
+        write_json_atomic(os.path.join(self.directory, f"{version}.json"), {"pytube": pytube.__version__, "plan": plan})
+    
+    def load_plan(self, version: str):
+        def decode(value):
+            if isinstance(value, list):
+                decoded = []
+                decoded.extend(decoded if item == {"self": True} else decode(item) for item in value)
+                return decoded
+            if isinstance(value, dict):
+                if set(value) == {"function"}:
+                    return getattr(pytube.cipher, value["function"])
+                return {key: decode(item) for key, item in value.items()}
+            return value
+        
+        try:
+            with open(os.path.join(self.directory, f"{version}.json")) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # The plan mirrors the internals of pytube's Cipher, so it only holds for the version that wrote it
+        if data.get("pytube") != pytube.__version__:
+            return None
+        cipher = Cipher.__new__(Cipher)
+        for name, value in data["plan"].items():
+            setattr(cipher, name, decode(value))
+        cipher.calculated_n = None
+        return cipher
+    
+    def forget(self, version: str):
+        with self.lock:
+            self.plans.pop(version, None)
+            self.scripts.pop(version, None)
+            self.versions = {digest: known for digest, known in self.versions.items() if known != version}
+        for extension in (".js", ".json"):
+            try:
+                os.remove(os.path.join(self.directory, version + extension))
+            except FileNotFoundError:
+                pass
+    
+    def summary(self):
+        return dict(self.stats, versions=len(self.scripts))
+
+player_cache = PlayerCache(PLAYER_CACHE_DIR)
+# pytube builds a Cipher from the player script for every YouTube object it resolves
+pytube.extract.Cipher = player_cache.cipher
+
+class VideoMetadataCache:
+    """Caches resolved pytube metadata per video_id.
+
+    An entry is a YouTube object whose title, length and stream list have already been fetched,
+    so its streams carry deciphered URLs and remember their filesizes. Unavailable videos are
+    cached as the exception pytube raised for them.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # video_id -> (expires_at, YouTube or VideoUnavailable)
+        self.resolving = {}  # video_id -> [lock, number of lookups holding or waiting for it]
+        self.stats = Counter()
+    
+    def get(self, video_id: str):
+        with self.lock:
+            resolving = self.resolving.setdefault(video_id, [threading.Lock(), 0])
+            resolving[1] += 1
+        try:
+            # Jobs for the same video wait for one lookup instead of each doing their own
+            with resolving[0]:
+                return self.lookup(video_id)
+        finally:
+            with self.lock:
+                resolving[1] -= 1
+                if not resolving[1]:
+                    del self.resolving[video_id]
+    
+    def lookup(self, video_id: str):
+        expires_at, value = self.entries.get(video_id, (0, None))
+        if expires_at > time.time():
+            self.stats["negative_hits" if isinstance(value, VideoUnavailable) else "hits"] += 1
+            if isinstance(value, VideoUnavailable):
+                raise value
+            return value
+        
+        self.stats["misses"] += 1
+        now = time.time()
+        try:
+            yt = YouTube(f"https://www.youtube.com/watch?v={video_id}")
+            yt._js = player_cache.script(yt.js_url)
+            yt.title, yt.length, yt.streams  # fetch and decipher everything up front
+        except VideoUnavailable as e:
+            self.store(video_id, now + METADATA_NEGATIVE_TTL, e)
+            raise
+        expires_at = now + METADATA_TTL
+        for stream in yt.streams:
+            expire = parse_qs(urlparse(stream.url).query).get("expire")
+            if expire and expire[0].isdigit():
+                expires_at = min(expires_at, int(expire[0]) - METADATA_EXPIRY_MARGIN)
+        self.store(video_id, expires_at, yt)
+        return yt
+    
+    def store(self, video_id: str, expires_at: float, value):
+        now = time.time()
+        with self.lock:
+            for stale_id in [key for key, (expiry, _) in self.entries.items() if expiry <= now]:
+                del self.entries[stale_id]
+            if expires_at > now:
+                self.entries[video_id] = (expires_at, value)
+    
+    def summary(self):
+        lookups = self.stats["hits"] + self.stats["negative_hits"] + self.stats["misses"]
+        hit_rate = (self.stats["hits"] + self.stats["negative_hits"]) / lookups if lookups else None
+        return dict(self.stats, entries=len(self.entries), hit_rate=hit_rate)
 
-# In-memory storage for download tasks
-download_tasks = {}
+video_metadata = VideoMetadataCache()
 
 # Helper functions
 def safe_filename(filename):
@@ -51,113 +899,1759 @@ def get_video_id(url):
         return parsed_url.path[1:]  # Extract video ID from short URL
     return None
 
-async def download_and_process_video(task_id: str, url: str, target_resolution: str):
-    task = download_tasks[task_id]
-    task.status = "Downloading"
+def resolution_height(resolution):
+    return int(resolution.rstrip("p"))
+
+def codec_family(video_codec):
+    # pytube reports full codec strings such as "avc1.640028" or "av01.0.08M.08"
+    return (video_codec or "").split(".")[0]
+
+def select_video_stream(streams, target_resolution, codec_preference, max_fps):
+    """Pick the smallest adaptive video stream at or above the target resolution.
+
+    Returns the stream together with a human readable reason for the choice.
+    """
+    candidates = [s for s in streams.filter(adaptive=True, only_video=True) if s.resolution]
+    if not candidates:
+        return None, "no adaptive video streams available"
+    
+    target_height = resolution_height(target_resolution)
+    at_or_above = [s for s in candidates if resolution_height(s.resolution) >= target_height]
+    if at_or_above:
+        height = min(resolution_height(s.resolution) for s in at_or_above)
+        reason = f"smallest stream at or above {target_resolution} is {height}p"
+    else:
+        height = max(resolution_height(s.resolution) for s in candidates)
+        reason = f"no stream reaches {target_resolution}, using best available {height}p"
+    same_height = [s for s in candidates if resolution_height(s.resolution) == height]
+    
+    within_fps = [s for s in same_height if (s.fps or 0) <= max_fps]
+    if within_fps:
+        same_height = within_fps
+    else:
+        reason += f"; no stream within {max_fps}fps"
+    
+    def rank(stream):
+        family = codec_family(stream.video_codec)
+        codec_rank = codec_preference.index(family) if family in codec_preference else len(codec_preference)
+        return (codec_rank, -(stream.fps or 0), stream.filesize or 0)
+    
+    stream = min(same_height, key=rank)
+    reason += f"; chose {codec_family(stream.video_codec) or 'unknown codec'} at {stream.fps}fps by codec preference {','.join(codec_preference)}"
+    return stream, reason
+
+def track_download_progress(task_id: str):
+    # Progress callback shared by every chunk of the video and audio downloads of one task
+    lock = threading.Lock()
+    
+    def on_progress(nbytes):
+        with lock:
+            task = task_store.get(task_id)
+            task.downloaded_bytes = (task.downloaded_bytes or 0) + nbytes
+    
+    return on_progress
+
+def resolve_streams(task_id: str, url: str, target_resolution: str, codec_preference, max_fps, video_only=False):
+    # Runs in the download thread pool: metadata lookup blocks on the network
+    video_id = get_video_id(url)
+    if not video_id:
+        raise ValueError("Invalid YouTube URL")
+    
+    yt = video_metadata.get(video_id)
+    safe_title = safe_filename(yt.title)
+    task_store.get(task_id).duration = yt.length
+    
+    stream, reason = select_video_stream(yt.streams, target_resolution, codec_preference, max_fps)
+    
+    if not stream:
+        raise Exception("No suitable video stream found")
+    
+    logger.info(f"Task {task_id} selected itag {stream.itag} ({stream.resolution}, {stream.video_codec}): {reason}")
+    task_store.get(task_id).selected_stream = {
+        "itag": stream.itag,
+        "resolution": stream.resolution,
+        "video_codec": stream.video_codec,
+        "fps": stream.fps,
+        "filesize": stream.filesize,
+        "reason": reason,
+    }
+    
+    if video_only:
+        return safe_title, stream, None
     
+    # Prefer AAC in mp4 so the audio can be muxed without re-encoding
+    audio_stream = (yt.streams.filter(only_audio=True, subtype="mp4").order_by("abr").desc().first()
+                    or yt.streams.filter(only_audio=True).first())
+    if not audio_stream:
+        raise Exception("No audio stream found")
+    
+    return safe_title, stream, audio_stream
+
+def write_json_atomic(path: str, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def load_download_manifest(manifest_file: str, filesize: int, chunk_size: int):
+    # Returns the set of range starts already written to disk, or an empty set if the manifest doesn't apply
     try:
-        logger.info(f"Starting download for task {task_id}: {url}")
-        video_id = get_video_id(url)
-        if not video_id:
-            raise ValueError("Invalid YouTube URL")
-        
-        yt = YouTube(f"https://www.youtube.com/watch?v={video_id}")
-        safe_title = safe_filename(yt.title)
-        
-        # Get the highest resolution stream
-        stream = yt.streams.filter(progressive=False, file_extension="mp4").order_by("resolution").desc().first()
-        
-        if not stream:
-            raise Exception("No suitable video stream found")
-        
-        logger.info(f"Downloading video: {stream.resolution}")
-        video_file = os.path.join(DOWNLOAD_DIR, f"{task_id}_{safe_title}_video.mp4")
-        stream.download(output_path=DOWNLOAD_DIR, filename=video_file)
-        
-        # Download audio separately
-        audio_stream = yt.streams.filter(only_audio=True).first()
-        if not audio_stream:
-            raise Exception("No audio stream found")
-        
-        logger.info("Downloading audio")
-        audio_file = os.path.join(DOWNLOAD_DIR, f"{task_id}_{safe_title}_audio.mp4")
-        audio_stream.download(output_path=DOWNLOAD_DIR, filename=audio_file)
-        
-        logger.info(f"Download completed for task {task_id}. Starting processing.")
-        task.status = "Processing"
-        
-        # Process video
-        output_file = os.path.join(DOWNLOAD_DIR, f"{task_id}_{safe_title}_{target_resolution}.mp4")
-        
-        if target_resolution == "2160p":
-            target_size = "3840x2160"
-        elif target_resolution == "1080p":
-            target_size = "1920x1080"
-        elif target_resolution == "720p":
-            target_size = "1280x720"
-        elif target_resolution == "480p":
-            target_size = "854x480"
-        else:
-            raise ValueError(f"Invalid resolution: {target_resolution}")
-        
-        logger.info(f"Processing video to {target_resolution}")
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    if manifest.get("filesize") != filesize or manifest.get("chunk_size") != chunk_size:
+        logger.info(f"Ignoring stale download manifest {manifest_file}")
+        return set()
+    return set(manifest.get("completed", []))
+
+def audio_kbps(stream):
+    return int((stream.abr or "0kbps").rstrip("kbps") or 0)
+
+def resolve_audio_stream(task_id: str, url: str, audio_format: str, bitrate: int = None):
+    # Runs in the download thread pool: pick the audio stream for an audio-only request
+    video_id = get_video_id(url)
+    if not video_id:
+        raise ValueError("Invalid YouTube URL")
+    
+    yt = video_metadata.get(video_id)
+    safe_title = safe_filename(yt.title)
+    task = task_store.get(task_id)
+    task.duration = yt.length
+    
+    subtype = AUDIO_FORMATS[audio_format][0]
+    candidates = list(yt.streams.filter(only_audio=True, subtype=subtype)) or list(yt.streams.filter(only_audio=True))
+    if not candidates:
+        raise Exception("No audio stream found")
+    
+    if bitrate:
+        stream = min(candidates, key=lambda s: abs(audio_kbps(s) - bitrate))
+        reason = f"closest to {bitrate}kbps"
+    else:
+        stream = max(candidates, key=audio_kbps)
+        reason = "highest bitrate"
+    reason += f" among {stream.subtype} audio streams"
+    
+    logger.info(f"Task {task_id} selected audio itag {stream.itag} ({stream.abr}, {stream.audio_codec}): {reason}")
+    task.selected_stream = {
+        "itag": stream.itag,
+        "abr": stream.abr,
+        "audio_codec": stream.audio_codec,
+        "filesize": stream.filesize,
+        "reason": reason,
+    }
+    return safe_title, stream
+
+def fetch_range(url: str, fd: int, start: int, end: int, on_progress=None, dest: int = None):
+    # Fetch bytes start..end (inclusive) into fd at dest (default: the same offset), retrying this range on its own
+    if dest is None:
+        dest = start
+    for attempt in range(1, CHUNK_RETRIES + 1):
+        written = 0
+        try:
+            with http_session.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True, timeout=30) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise IOError(f"Server ignored range request for bytes {start}-{end}")
+                for block in response.iter_content(chunk_size=64 * 1024):
+                    os.pwrite(fd, block, dest + written)
+                    written += len(block)
+                    if on_progress:
+                        on_progress(len(block))
+            if written != end - start + 1:
+                raise IOError(f"Short read for bytes {start}-{end}: got {written}")
+            return written
+        except (requests.RequestException, IOError) as e:
+            if on_progress and written:
+                on_progress(-written)
+            if attempt == CHUNK_RETRIES:
+                raise
+            logger.warning(f"Retrying bytes {start}-{end} (attempt {attempt}/{CHUNK_RETRIES}): {str(e)}")
+            time.sleep(2 ** (attempt - 1))
+
+def ranged_download(url: str, filename: str, filesize: int, on_progress=None,
+                    connections: int = DOWNLOAD_CONNECTIONS, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+    """Download url into a preallocated file using parallel HTTP range requests.
+
+    Completed ranges are checkpointed in a sidecar manifest next to the file, so a download
+    interrupted by a crash or restart only fetches the ranges that are still missing.
+    """
+    manifest_file = f"{filename}.manifest"
+    completed = set()
+    if os.path.exists(filename) and os.path.getsize(filename) == filesize:
+        completed = load_download_manifest(manifest_file, filesize, chunk_size)
+    
+    ranges = [(start, min(start + chunk_size, filesize) - 1) for start in range(0, filesize, chunk_size)]
+    missing = [(start, end) for start, end in ranges if start not in completed]
+    if completed:
+        resumed = sum(end - start + 1 for start, end in ranges if start in completed)
+        logger.info(f"Resuming {filename}: {resumed} of {filesize} bytes already on disk")
+        if on_progress:
+            on_progress(resumed)
+    
+    lock = threading.Lock()
+    
+    def checkpoint(start):
+        with lock:
+            completed.add(start)
+            write_json_atomic(manifest_file, {"filesize": filesize, "chunk_size": chunk_size,
+                                              "completed": sorted(completed)})
+    
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, filesize)
+        with ThreadPoolExecutor(max_workers=connections, thread_name_prefix="chunk") as pool:
+            futures = {pool.submit(fetch_range, url, fd, start, end, on_progress): start for start, end in missing}
+            for future in as_completed(futures):
+                future.result()
+                checkpoint(futures[future])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    return filename
+
+def download_stream(stream, filename: str, on_progress=None):
+    # Runs in the download thread pool
+    filesize = stream.filesize
+    if not filesize:
+        # Without a known size there is nothing to split, fall back to pytube's sequential fetch
+        stream.download(output_path=DOWNLOAD_DIR, filename=filename)
+        return filename
+    return ranged_download(stream.url, filename, filesize, on_progress)
+
+def mp4_is_streamable(url: str):
+    # ffmpeg can demux an mp4 from a pipe only if moov (or a fragment) comes before the media data
+    response = http_session.get(url, headers={"Range": "bytes=0-65535"}, timeout=30)
+    response.raise_for_status()
+    head = response.content
+    offset = 0
+    while offset + 8 <= len(head):
+        size, box = struct.unpack(">I4s", head[offset:offset + 8])
+        if box in (b"moov", b"moof", b"sidx"):
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1 and offset + 16 <= len(head):
+            size = struct.unpack(">Q", head[offset + 8:offset + 16])[0]
+        if size < 8:
+            break
+        offset += size
+    return False
+
+def can_stream(*streams):
+    # Runs in the download thread pool
+    for stream in streams:
+        if stream is None:
+            continue
+        if not stream.filesize:
+            return False
+        if stream.subtype != "webm" and not mp4_is_streamable(stream.url):
+            return False
+    return True
+
+def open_pipe_writer(fifo_path: str, stop: threading.Event):
+    # Wait for ffmpeg to open the read end without blocking forever if it never does
+    while not stop.is_set():
+        try:
+            fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            time.sleep(0.1)
+            continue
+        os.set_blocking(fd, True)
+        return fd
+    return None
+
+def feed_pipe(url: str, filesize: int, fifo_path: str, stop: threading.Event, on_progress=None):
+    # Runs in the download thread pool: stream url into a named pipe in sequential ranges
+    fd = open_pipe_writer(fifo_path, stop)
+    if fd is None:
+        return 0
+    offset = 0
+    attempt = 0
+    try:
+        while offset < filesize:
+            end = min(offset + DOWNLOAD_CHUNK_SIZE, filesize) - 1
+            try:
+                with http_session.get(url, headers={"Range": f"bytes={offset}-{end}"}, stream=True, timeout=30) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        # A full 200 body would be written into the pipe after the bytes already sent
+                        raise IOError(f"Server ignored range request for bytes {offset}-{end}")
+                    for block in response.iter_content(chunk_size=64 * 1024):
+                        view = memoryview(block)
+                        while view:
+                            view = view[os.write(fd, view):]
+                        offset += len(block)
+                        if on_progress:
+                            on_progress(len(block))
+                attempt = 0
+            except requests.RequestException as e:
+                # Bytes already in the pipe can't be taken back, so resume from the current offset
+                attempt += 1
+                if attempt >= CHUNK_RETRIES:
+                    raise
+                logger.warning(f"Retrying stream from byte {offset} (attempt {attempt}/{CHUNK_RETRIES}): {str(e)}")
+                time.sleep(2 ** (attempt - 1))
+    finally:
+        os.close(fd)
+    return offset
+
+def parse_sidx(sidx: bytes, sidx_offset: int, start: float, end: float):
+    # Returns (media byte ranges covering start..end, time of the first covered subsegment) or None
+    version = sidx[8]
+    timescale = struct.unpack(">I", sidx[16:20])[0]
+    if version == 0:
+        earliest, first_offset = struct.unpack(">II", sidx[20:28])
+        pos = 28
+    else:
+        earliest, first_offset = struct.unpack(">QQ", sidx[20:36])
+        pos = 36
+    reference_count = struct.unpack(">H", sidx[pos + 2:pos + 4])[0]
+    pos += 4
+    
+    media_offset = sidx_offset + len(sidx) + first_offset
+    segment_start = earliest / timescale
+    first = last = origin = None
+    for _ in range(reference_count):
+        reference, duration, _ = struct.unpack(">III", sidx[pos:pos + 12])
+        pos += 12
+        size = reference & 0x7FFFFFFF
+        segment_end = segment_start + duration / timescale
+        if segment_end > start and segment_start < end:
+            if first is None:
+                first, origin = media_offset, segment_start
+            last = media_offset + size - 1
+        media_offset += size
+        segment_start = segment_end
+    if first is None:
+        return None
+    return [(first, last)], origin
+
+def clip_byte_ranges(url: str, start: float, end: float):
+    """Map a time range onto byte ranges of a fragmented mp4 stream using its sidx index.
+
+    Returns (ranges, origin): the init segment followed by the media subsegments covering
+    start..end, and the presentation time at which the first fetched subsegment begins.
+    Returns None for streams without a sidx (e.g. webm), which have to be fetched whole.
+    """
+    response = http_session.get(url, headers={"Range": "bytes=0-65535"}, timeout=30)
+    response.raise_for_status()
+    data = response.content
+    offset = 0
+    while offset + 8 <= len(data):
+        size, box = struct.unpack(">I4s", data[offset:offset + 8])
+        if size == 1 and offset + 16 <= len(data):
+            size = struct.unpack(">Q", data[offset + 8:offset + 16])[0]
+        if box == b"sidx":
+            if offset + size > len(data):
+                rest = http_session.get(url, headers={"Range": f"bytes={len(data)}-{offset + size - 1}"}, timeout=30)
+                rest.raise_for_status()
+                data += rest.content
+            plan = parse_sidx(data[offset:offset + size], offset, start, end)
+            if plan is None:
+                return None
+            media_ranges, origin = plan
+            # The init segment is everything before the sidx; the index itself is left out because it
+            # describes fragments the clip file won't have
+            return [(0, offset - 1)] + media_ranges, origin
+        if box in (b"moof", b"mdat") or size < 8:
+            return None
+        offset += size
+    return None
+
+def download_ranges(url: str, filename: str, ranges: list, on_progress=None,
+                    connections: int = DOWNLOAD_CONNECTIONS, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+    # Fetch the given byte ranges of url back to back into one file, in parallel chunks
+    pieces = []
+    dest = 0
+    for first, last in ranges:
+        for start in range(first, last + 1, chunk_size):
+            end = min(start + chunk_size, last + 1) - 1
+            pieces.append((start, end, dest))
+            dest += end - start + 1
+    
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, dest)
+        with ThreadPoolExecutor(max_workers=connections, thread_name_prefix="chunk") as pool:
+            futures = [pool.submit(fetch_range, url, fd, start, end, on_progress, piece_dest)
+                       for start, end, piece_dest in pieces]
+            for future in as_completed(futures):
+                future.result()
+    finally:
+        os.close(fd)
+    return filename
+
+# Audio codecs the mp4 container carries as-is; anything else (opus, vorbis) is transcoded to AAC
+MP4_AUDIO_CODECS = {"aac", "mp3", "alac"}
+
+def probe_stream(media_file: str, codec_type: str):
+    # Returns the ffprobe description of the first stream of the given type, or None
+    probe = ffmpeg.probe(media_file)
+    for stream in probe.get("streams", []):
+        if stream.get("codec_type") == codec_type:
+            return stream
+    return None
+
+def probe_video(video_file: str):
+    # Returns (codec_name, width, height) of the first video stream, or None if ffprobe finds none
+    stream = probe_stream(video_file, "video")
+    if stream:
+        return stream.get("codec_name"), int(stream.get("width", 0)), int(stream.get("height", 0))
+    return None
+
+def mp4_output_args():
+    # An empty moov up front and a fragment per keyframe make every written byte final, so the
+    # file can be read while ffmpeg is still appending to it
+    return {"movflags": "frag_keyframe+empty_moov"} if PROGRESSIVE_DOWNLOADS else {}
+
+def audio_output_args(audio_file: str, audio_codec: str = None):
+    if audio_codec is None:
+        audio = probe_stream(audio_file, "audio")
+        audio_codec = audio.get("codec_name") if audio else None
+    if audio_codec in MP4_AUDIO_CODECS:
+        return {"acodec": "copy"}
+    return {"acodec": "aac", "audio_bitrate": AUDIO_BITRATE}
+
+def report_transcode_progress(task_id: str, progress: dict, duration):
+    # Turn one block of ffmpeg -progress output into task fields and hand them to the main process
+    out_time_us = progress.get("out_time_us") or progress.get("out_time_ms")  # both are microseconds
+    try:
+        out_time = int(out_time_us) / 1_000_000
+    except (TypeError, ValueError):
+        return
+    try:
+        speed = float(progress.get("speed", "").rstrip("x"))
+    except ValueError:
+        speed = None
+    try:
+        fps = float(progress.get("fps", ""))
+    except ValueError:
+        fps = None
+    
+    update = {"encode_fps": fps, "encode_speed": speed}
+    if progress.get("progress") == "end":
+        update.update(transcode_percent=100.0, eta_seconds=0.0)
+    elif duration:
+        update["transcode_percent"] = round(min(100.0, out_time / duration * 100), 1)
+        if speed:
+            update["eta_seconds"] = round(max(0.0, duration - out_time) / speed, 1)
+    if worker_progress_queue is not None and task_id:
+        worker_progress_queue.put((task_id, update))
+
+def run_ffmpeg(stream, task_id: str = None, duration=None):
+    # Like stream.run(), but parses -progress output as it arrives
+    process = stream.global_args("-progress", "pipe:1", "-nostats").run_async(pipe_stdout=True, pipe_stderr=True)
+    stderr = []
+    stderr_reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    stderr_reader.start()
+    
+    progress = {}
+    for line in process.stdout:
+        key, _, value = line.decode(errors="replace").strip().partition("=")
+        progress[key] = value
+        if key == "progress":
+            report_transcode_progress(task_id, progress, duration)
+            progress = {}
+    
+    process.wait()
+    stderr_reader.join()
+    if process.returncode:
+        raise ffmpeg.Error("ffmpeg", b"", b"".join(stderr))
+
+def apply_transcode_progress():
+    # Runs on a daemon thread in the main process, draining progress reported by transcode workers
+    while True:
+        item = progress_queue.get()
+        if item is None:
+            return
+        task_id, update = item
+        task = task_store.get(task_id)
+        if task is None:
+            continue
+        for field, value in update.items():
+            setattr(task, field, value)
+
+def encoder_profile(resolution: str, preset: str = None, crf: int = None):
+    profile = dict(ENCODER_PROFILES[resolution])
+    if preset:
+        profile["preset"] = preset
+    if crf is not None:
+        profile["crf"] = crf
+    return profile
+
+def faster_preset(a: str, b: str):
+    return min(a, b, key=X264_PRESETS.index)
+
+def load_adjusted_preset(resolution: str):
+    # Returns a faster preset than the resolution's default if the queue is backing up, else None
+    fill = job_queue.qsize() / MAX_QUEUE_DEPTH
+    for threshold, preset in LOAD_PRESET_STEPS:
+        if fill >= threshold:
+            base = ENCODER_PROFILES[resolution]["preset"]
+            return preset if faster_preset(preset, base) != base else None
+    return None
+
+def convert_audio(audio_file: str, output_file: str, audio_format: str, bitrate: int = None,
+                  task_id: str = None, duration=None):
+    # Runs in the transcode process pool: remux when the source codec fits the format, else encode
+    _, copy_codec, encoder, _ = AUDIO_FORMATS[audio_format]
+    source = probe_stream(audio_file, "audio")
+    if source and source.get("codec_name") == copy_codec:
+        args, mode = {"acodec": "copy"}, "remux"
+    else:
+        args, mode = {"acodec": encoder, "audio_bitrate": f"{bitrate}k" if bitrate else AUDIO_BITRATE}, "transcode"
+    run_ffmpeg(
+        ffmpeg
+        .output(ffmpeg.input(audio_file).audio, output_file, vn=None, **args)
+        .overwrite_output(),
+        task_id, duration
+    )
+    return mode
+
+def scale_pad_filter(target_size: str):
+    # pad takes width and height as separate expressions, it does not parse a WxH size
+    width, height = target_size.split("x")
+    return f"scale={width}:{height}:force_original_aspect_ratio=decrease,pad={width}:{height}:-1:-1:color=black"
+
+def can_remux(source, target_size: str):
+    return bool(source) and source[0] == "h264" and f"{source[1]}x{source[2]}" == target_size
+
+def split_segments(video_file: str, segment_dir: str, segment_seconds: int):
+    # Runs in the transcode process pool. The segment muxer only cuts on keyframes, so every
+    # piece decodes on its own
+    pattern = os.path.join(segment_dir, "source_%05d.mp4")
+    (
+        ffmpeg
+        .input(video_file)
+        .output(pattern, c="copy", an=None, f="segment", segment_time=segment_seconds, reset_timestamps=1)
+        .overwrite_output()
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return sorted(glob.glob(os.path.join(segment_dir, "source_*.mp4")))
+
+def encode_segment(segment_file: str, output_file: str, target_size: str, profile: dict):
+    # Runs in the transcode process pool, one segment per worker
+    (
+        ffmpeg
+        .input(segment_file)
+        .output(output_file, vf=scale_pad_filter(target_size), threads=SEGMENT_ENCODER_THREADS, **profile)
+        .overwrite_output()
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return output_file
+
+def concat_segments(segment_files: list, audio_file: str, output_file: str):
+    # Runs in the transcode process pool: join encoded segments with the concat demuxer and mux the audio
+    list_file = os.path.join(os.path.dirname(segment_files[0]), "segments.txt")
+    with open(list_file, "w") as f:
+        for segment_file in segment_files:
+            escaped = os.path.abspath(segment_file).replace("'", "'\\''")
+            f.write(f"file '{escaped}'\n")
+    
+    streams = [ffmpeg.input(list_file, f="concat", safe=0).video]
+    audio_args = {}
+    if audio_file:
+        streams.append(ffmpeg.input(audio_file).audio)
+        audio_args = audio_output_args(audio_file)
+    (
+        ffmpeg
+        .output(*streams, output_file, vcodec="copy", **audio_args, **mp4_output_args())
+        .overwrite_output()
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return output_file
+
+def hls_playlist_bandwidth(playlist: str):
+    # BANDWIDTH must be the peak segment bit rate and AVERAGE-BANDWIDTH the overall one (RFC 8216 4.3.4.2),
+    # both measured from the segments actually written rather than the container's nominal bit rate
+    playlist_dir = os.path.dirname(playlist)
+    peak = total_bits = total_seconds = 0
+    segment_seconds = None
+    with open(playlist) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                segment_seconds = float(line[len("#EXTINF:"):].split(",")[0])
+            elif line and not line.startswith("#") and segment_seconds is not None:
+                bits = os.path.getsize(os.path.join(playlist_dir, line)) * 8
+                if segment_seconds > 0:
+                    peak = max(peak, bits / segment_seconds)
+                total_bits += bits
+                total_seconds += segment_seconds
+                segment_seconds = None
+    average = total_bits / total_seconds if total_seconds else 0
+    return math.ceil(peak), math.ceil(average)
+
+# ffprobe H.264 profile names -> profile_idc and constraint flags of an RFC 6381 avc1 codec string
+AVC_PROFILES = {"Constrained Baseline": "42E0", "Baseline": "4200", "Main": "4D00", "High": "6400"}
+
+def hls_codecs(source: str):
+    # The CODECS attribute of a variant, or None when a stream's codec string can't be derived
+    codecs = []
+    for stream in ffmpeg.probe(source)["streams"]:
+        if stream.get("codec_type") == "video":
+            profile = AVC_PROFILES.get(stream.get("profile"))
+            if stream.get("codec_name") != "h264" or profile is None or not stream.get("level"):
+                return None
+            codecs.append(f"avc1.{profile}{int(stream['level']):02X}")
+        elif stream.get("codec_type") == "audio":
+            if stream.get("codec_name") != "aac" or stream.get("profile", "LC") != "LC":
+                return None
+            codecs.append("mp4a.40.2")
+    return ",".join(codecs) or None
+
+def package_renditions(renditions: dict, output_format: str, package_dir: str):
+    """Package rendition MP4s (resolution -> path, highest first) as HLS or DASH without re-encoding.
+
+    Returns the manifest filename, relative to package_dir.
+    """
+    # Runs in the transcode process pool
+    os.makedirs(package_dir, exist_ok=True)
+    if output_format == "hls":
+        variants = []
+        for resolution, source in renditions.items():
+            rendition_dir = os.path.join(package_dir, resolution)
+            os.makedirs(rendition_dir, exist_ok=True)
+            (
+                ffmpeg
+                .input(source)
+                .output(os.path.join(rendition_dir, "index.m3u8"), c="copy", f="hls", hls_time=PACKAGE_SEGMENT_SECONDS,
+                        hls_playlist_type="vod", hls_segment_type="fmp4", hls_fmp4_init_filename="init.mp4",
+                        hls_segment_filename=os.path.join(rendition_dir, "segment_%05d.m4s"))
+                .overwrite_output()
+                .run(capture_stdout=True, capture_stderr=True)
+            )
+            peak, average = hls_playlist_bandwidth(os.path.join(rendition_dir, "index.m3u8"))
+            width, height = RESOLUTION_SIZES[resolution]
+            attributes = f"BANDWIDTH={peak},AVERAGE-BANDWIDTH={average},RESOLUTION={width}x{height}"
+            codecs = hls_codecs(source)
+            if codecs:
+                attributes += f',CODECS="{codecs}"'
+            variants.append(f"#EXT-X-STREAM-INF:{attributes}\n{resolution}/index.m3u8\n")
+        with open(os.path.join(package_dir, PACKAGE_FORMATS["hls"]), "w") as f:
+            f.write("#EXTM3U\n#EXT-X-VERSION:7\n" + "".join(variants))
+        return PACKAGE_FORMATS["hls"]
+    
+    # DASH: one manifest with a video representation per rendition and the audio of the first
+    inputs = [ffmpeg.input(source) for source in renditions.values()]
+    streams = [source.video for source in inputs]
+    adaptation_sets = "id=0,streams=v"
+    if probe_stream(next(iter(renditions.values())), "audio"):
+        streams.append(inputs[0].audio)
+        adaptation_sets += " id=1,streams=a"
+    (
+        ffmpeg
+        .output(*streams, os.path.join(package_dir, PACKAGE_FORMATS["dash"]), c="copy", f="dash",
+                seg_duration=PACKAGE_SEGMENT_SECONDS, use_template=1, use_timeline=1, adaptation_sets=adaptation_sets,
+                init_seg_name="init_$RepresentationID$.m4s", media_seg_name="chunk_$RepresentationID$_$Number%05d$.m4s")
+        .overwrite_output()
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return PACKAGE_FORMATS["dash"]
+
+def media_start_time(media_file: str):
+    return float(ffmpeg.probe(media_file)["format"].get("start_time", 0))
+
+def first_keyframe_after(video_file: str, start: float, end: float):
+    probe = ffmpeg.probe(video_file, select_streams="v:0", skip_frame="nokey",
+                         show_entries="frame=pts_time", read_intervals=f"{start}%{end}")
+    times = [float(frame["pts_time"]) for frame in probe.get("frames", []) if "pts_time" in frame]
+    later = [t for t in times if start <= t < end]
+    return min(later) if later else None
+
+def cut_clip(video_file: str, audio_file: str, output_file: str, target_resolution: str, profile: dict,
+             start: float, end: float, video_origin: float = 0.0, audio_origin: float = 0.0, task_id: str = None):
+    """Cut start..end out of (partially) downloaded sources.
+
+    The origins are the source times at which the downloaded files begin, so a file that holds only
+    the covering subsegments is seeked to the right place whether or not ffmpeg honours its tfdt.
+    """
+    # Runs in the transcode process pool
+    target_size = "x".join(str(n) for n in RESOLUTION_SIZES[target_resolution])
+    duration = end - start
+    # Input seeks are relative to the file's start time, whatever timestamps its fragments carry
+    video_start = start - video_origin
+    audio = None
+    audio_args = {}
+    if audio_file:
+        audio = ffmpeg.input(audio_file, ss=start - audio_origin, t=duration).audio
+        audio_args = audio_output_args(audio_file)
+    
+    source = probe_video(video_file)
+    keyframe = None
+    if can_remux(source, target_size):
+        # ffprobe reports and reads intervals in absolute timestamps
+        offset = media_start_time(video_file)
+        keyframe = first_keyframe_after(video_file, video_start + offset, video_start + offset + duration)
+        if keyframe is not None:
+            keyframe -= offset
+    if keyframe is None:
+        # The clip has to be scaled anyway (or has no keyframe to copy from); it is short, so encode all of it
+        video = ffmpeg.input(video_file, ss=video_start, t=duration).video
+        streams = [video, audio] if audio else [video]
+        run_ffmpeg(
+            ffmpeg
+            .output(*streams, output_file, vf=scale_pad_filter(target_size), **profile, **audio_args)
+            .overwrite_output(),
+            task_id, duration
+        )
+        return "clip"
+    
+    # Smart cut: re-encode only the frames before the first keyframe, stream-copy the rest. The parts
+    # are MPEG-TS so each keeps its own in-band parameter sets when the concat demuxer joins them
+    parts = []
+    if keyframe - video_start > 0.001:
+        head = f"{output_file}.head.ts"
         (
             ffmpeg
-            .input(video_file)
-            .output(output_file, vf=f"scale={target_size}:force_original_aspect_ratio=decrease,pad={target_size}:-1:-1:color=black", 
-                    acodec="copy", vcodec="libx264", preset="medium")
+            .input(video_file, ss=video_start, t=keyframe - video_start)
+            .output(head, an=None, **profile)
             .overwrite_output()
             .run(capture_stdout=True, capture_stderr=True)
         )
+        parts.append(head)
+    body = f"{output_file}.body.ts"
+    (
+        ffmpeg
+        .input(video_file, ss=keyframe, t=video_start + duration - keyframe)
+        .output(body, an=None, vcodec="copy")
+        .overwrite_output()
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    parts.append(body)
+    
+    list_file = f"{output_file}.parts.txt"
+    with open(list_file, "w") as f:
+        for part in parts:
+            f.write(f"file '{os.path.abspath(part)}'\n")
+    parts.append(list_file)
+    
+    try:
+        video = ffmpeg.input(list_file, f="concat", safe=0).video
+        streams = [video, audio] if audio else [video]
+        run_ffmpeg(
+            ffmpeg
+            .output(*streams, output_file, vcodec="copy", **audio_args)
+            .overwrite_output(),
+            task_id, duration
+        )
+    finally:
+        for part in parts:
+            os.remove(part)
+    return "clip-smartcut"
+
+def transcode_video(video_file: str, audio_file: str, outputs: dict, profiles: dict,
+                    source=None, audio_codec: str = None, task_id: str = None, duration=None):
+    """Encode the inputs into one output file per resolution in outputs.
+
+    Several resolutions are produced by a single ffmpeg invocation that decodes the source once
+    and splits it into one scaler/encoder chain per rendition.
+    """
+    # Runs in the transcode process pool so encodes never compete with the event loop for the GIL.
+    # Inputs may be named pipes, in which case the caller passes source/audio_codec so nothing
+    # has to be probed from the pipe itself
+    for target_resolution in outputs:
+        if target_resolution not in RESOLUTION_SIZES:
+            raise ValueError(f"Invalid resolution: {target_resolution}")
+    
+    video = ffmpeg.input(video_file).video
+    audio = None
+    audio_args = {}
+    if audio_file:
+        audio = ffmpeg.input(audio_file).audio
+        audio_args = audio_output_args(audio_file, audio_codec)
+    
+    if len(outputs) > 1:
+        split = video.filter_multi_output("split", len(outputs))
+        renditions = []
+        for index, (target_resolution, output_file) in enumerate(outputs.items()):
+            width, height = RESOLUTION_SIZES[target_resolution]
+            scaled = (
+                split.stream(index)
+                .filter("scale", width, height, force_original_aspect_ratio="decrease")
+                .filter("pad", width, height, -1, -1, color="black")
+            )
+            streams = [scaled, audio] if audio else [scaled]
+            renditions.append(ffmpeg.output(*streams, output_file, **profiles[target_resolution], **audio_args,
+                                            **mp4_output_args()))
+        run_ffmpeg(ffmpeg.merge_outputs(*renditions).overwrite_output(), task_id, duration)
+        return "ladder"
+    
+    target_resolution, output_file = next(iter(outputs.items()))
+    target_size = "x".join(str(n) for n in RESOLUTION_SIZES[target_resolution])
+    streams = [video, audio] if audio else [video]
+    
+    # Fast path: an H.264 source that already has the target dimensions only needs a remux
+    if source is None:
+        source = probe_video(video_file)
+    if can_remux(source, target_size):
+        logger.info(f"Source already {target_size} H.264, remuxing {video_file} without re-encoding")
+        run_ffmpeg(
+            ffmpeg
+            .output(*streams, output_file, vcodec="copy", **audio_args, **mp4_output_args())
+            .overwrite_output(),
+            task_id, duration
+        )
+        return "remux"
+    
+    run_ffmpeg(
+        ffmpeg
+        .output(*streams, output_file, vf=scale_pad_filter(target_size), **profiles[target_resolution], **audio_args,
+                **mp4_output_args())
+        .overwrite_output(),
+        task_id, duration
+    )
+    return "transcode"
+
+def wants_segmented_encode(outputs: dict, duration, source_media: str):
+    # Splitting only pays off for a single long rendition that really has to be re-encoded, and
+    # telling whether it does takes a probe of the source (a file or a stream URL)
+    if len(outputs) != 1 or not SEGMENT_SECONDS or (duration or 0) <= 2 * SEGMENT_SECONDS:
+        return False
+    target_size = "x".join(str(n) for n in RESOLUTION_SIZES[next(iter(outputs))])
+    return not can_remux(probe_video(source_media), target_size)
+
+async def segmented_transcode(task_id: str, video_file: str, audio_file: str, target_resolution: str,
+                              output_file: str, profile: dict):
+    task = task_store.get(task_id)
+    loop = asyncio.get_running_loop()
+    target_size = "x".join(str(n) for n in RESOLUTION_SIZES[target_resolution])
+    segment_dir = os.path.join(DOWNLOAD_DIR, f"{task_id}_segments")
+    os.makedirs(segment_dir, exist_ok=True)
+    
+    try:
+        segments = await loop.run_in_executor(
+            transcode_executor, split_segments, video_file, segment_dir, SEGMENT_SECONDS)
+        logger.info(f"Encoding task {task_id} as {len(segments)} segments across {TRANSCODE_WORKERS} workers")
         
-        # Clean up temporary files
-        os.remove(video_file)
+        done = 0
+        
+        async def encode(segment_file):
+            nonlocal done
+            encoded = await loop.run_in_executor(
+                transcode_executor, encode_segment, segment_file,
+                segment_file.replace("source_", "encoded_"), target_size, profile)
+            done += 1
+            task.transcode_percent = round(done / len(segments) * 100, 1)
+            return encoded
+        
+        encoded = await asyncio.gather(*(encode(segment_file) for segment_file in segments))
+        await loop.run_in_executor(transcode_executor, concat_segments, encoded, audio_file, output_file)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+    return "segmented"
+
+async def download_then_process(task_id: str, safe_title: str, video_stream, audio_stream, outputs: dict, profiles: dict):
+    task = task_store.get(task_id)
+    loop = asyncio.get_running_loop()
+    on_progress = track_download_progress(task_id)
+    
+    # Fetch video and audio in parallel; processing starts once both have landed
+    video_file = os.path.join(DOWNLOAD_DIR, f"{task_id}_{safe_title}_video.mp4")
+    downloads = [loop.run_in_executor(download_executor, download_stream, video_stream, video_file, on_progress)]
+    audio_file = None
+    if audio_stream:
+        audio_file = os.path.join(DOWNLOAD_DIR, f"{task_id}_{safe_title}_audio.{audio_stream.subtype}")
+        downloads.append(loop.run_in_executor(download_executor, download_stream, audio_stream, audio_file, on_progress))
+    
+    logger.info(f"Downloading video {video_stream.resolution}"
+                + (f" and audio {audio_stream.abr}" if audio_stream else "") + f" for task {task_id}")
+    await asyncio.gather(*downloads)
+    
+    logger.info(f"Download completed for task {task_id}. Starting processing.")
+    task.status = "Processing"
+    
+    logger.info(f"Processing video to {', '.join(outputs)}")
+    if await loop.run_in_executor(download_executor, wants_segmented_encode, outputs, task.duration, video_file):
+        target_resolution, output_file = next(iter(outputs.items()))
+        mode = await segmented_transcode(task_id, video_file, audio_file, target_resolution, output_file,
+                                         profiles[target_resolution])
+    else:
+        mode = await loop.run_in_executor(
+            transcode_executor, transcode_video, video_file, audio_file, outputs, profiles,
+            None, None, task_id, task.duration)
+    
+    # Clean up temporary files
+    os.remove(video_file)
+    if audio_file:
         os.remove(audio_file)
+    return mode
+
+async def stream_and_process(task_id: str, video_stream, audio_stream, outputs: dict, profiles: dict):
+    task = task_store.get(task_id)
+    loop = asyncio.get_running_loop()
+    on_progress = track_download_progress(task_id)
+    
+    # The pipe can't be probed without consuming it, so probe the source URL headers instead
+    source = await loop.run_in_executor(download_executor, probe_video, video_stream.url)
+    audio_codec = None
+    if audio_stream:
+        audio_codec = "aac" if codec_family(audio_stream.audio_codec) == "mp4a" else codec_family(audio_stream.audio_codec)
+    
+    stop = threading.Event()
+    fifos = []
+    feeders = []
+    for kind, stream in (("video", video_stream), ("audio", audio_stream)):
+        if stream is None:
+            continue
+        fifo = os.path.join(DOWNLOAD_DIR, f"{task_id}_{kind}.fifo")
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+        fifos.append(fifo)
+        feeders.append(loop.run_in_executor(
+            download_executor, feed_pipe, stream.url, stream.filesize, fifo, stop, on_progress))
+    
+    logger.info(f"Streaming task {task_id} into ffmpeg at {', '.join(outputs)}")
+    task.status = "Processing"
+    try:
+        mode = await loop.run_in_executor(
+            transcode_executor, transcode_video, fifos[0], fifos[1] if len(fifos) > 1 else None,
+            outputs, profiles, source, audio_codec, task_id, task.duration)
+    finally:
+        stop.set()
+        results = await asyncio.gather(*feeders, return_exceptions=True)
+        for fifo in fifos:
+            os.remove(fifo)
+    
+    # ffmpeg treats a dead feeder as end of input, so a feeder error means the output is truncated
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return mode
+
+def primary_rendition(request: DownloadRequest):
+    return request.audio_format or request.resolution
+
+def rendition_profile(request: DownloadRequest, rendition: str):
+    if request.audio_format:
+        return {"audio_format": request.audio_format, "audio_bitrate": request.audio_bitrate}
+    return encoder_profile(rendition, request.preset, request.crf)
+
+def output_cache_key(video_id: str, request: DownloadRequest):
+    # Everything that changes the bytes of the output has to be part of the key
+    rendition = primary_rendition(request)
+    profile = rendition_profile(request, rendition)
+    if not request.audio_format:
+        profile.update(audio_bitrate=AUDIO_BITRATE, video_only=request.video_only, max_fps=request.max_fps or MAX_FPS,
+                       codec=request.codec)
+        if request.start is not None or request.end is not None:
+            profile.update(start=request.start, end=request.end)
+    profile_hash = hashlib.sha256(json.dumps(profile, sort_keys=True).encode()).hexdigest()[:16]
+    return hashlib.sha256(f"{video_id}:{rendition}:{profile_hash}".encode()).hexdigest()
+
+def requested_resolutions(request: DownloadRequest):
+    # The primary resolution plus any ladder renditions, highest first
+    resolutions = set(request.resolutions or []) | {request.resolution}
+    return sorted(resolutions, key=resolution_height, reverse=True)
+
+def rendition_cache_keys(video_id: str, request: DownloadRequest):
+    if request.audio_format:
+        return {request.audio_format: output_cache_key(video_id, request)}
+    return {resolution: output_cache_key(video_id, request.model_copy(update={"resolution": resolution}))
+            for resolution in requested_resolutions(request)}
+
+def package_cache_key(video_id: str, request: DownloadRequest):
+    # A package is built from exactly the renditions of the request
+    keys = sorted(rendition_cache_keys(video_id, request).values())
+    return hashlib.sha256(f"{request.output_format}:{'+'.join(keys)}".encode()).hexdigest()
+
+def job_key(video_id: str, request: DownloadRequest):
+    # Identical jobs produce the same set of outputs; a plain request's key is its cache key
+    keys = sorted(rendition_cache_keys(video_id, request).values())
+    if request.output_format in PACKAGE_FORMATS:
+        keys.append(package_cache_key(video_id, request))
+    if len(keys) == 1:
+        return keys[0]
+    return hashlib.sha256("+".join(keys).encode()).hexdigest()
+
+def cache_path(cache_key: str, filename: str = None):
+    # Cached files keep the extension of the name they are served under; packages are directories
+    if filename is None:
+        entry = output_cache.get(cache_key) or {}
+        if entry.get("package"):
+            return os.path.join(CACHE_DIR, cache_key)
+        filename = entry.get("filename", "")
+    return os.path.join(CACHE_DIR, cache_key + (os.path.splitext(filename)[1] or ".mp4"))
+
+def lookup_cached_output(cache_key: str):
+    entry = output_cache.get(cache_key)
+    if entry and os.path.exists(cache_path(cache_key)):
+        return entry
+    return None
+
+def store_cached_output(cache_key: str, output_file: str, filename: str, keep=()):
+    # keep: other entries the caller still needs, such as earlier renditions of the same job
+    path = cache_path(cache_key, filename)
+    shutil.move(output_file, path)
+    now = time.time()
+    output_cache.put(cache_key, {"filename": filename, "size": os.path.getsize(path),
+                                 "created": now, "last_access": now, "hits": 0})
+    evict_cached_outputs(keep={cache_key, *keep})
+    output_cache.flush()
+
+def store_cached_package(cache_key: str, package_dir: str, manifest: str, output_format: str, keep=()):
+    path = os.path.join(CACHE_DIR, cache_key)
+    shutil.move(package_dir, path)
+    size = sum(os.path.getsize(file) for file in glob.glob(os.path.join(path, "**"), recursive=True)
+               if os.path.isfile(file))
+    now = time.time()
+    entry = {"filename": manifest, "size": size, "package": output_format,
+             "created": now, "last_access": now, "hits": 0}
+    output_cache.put(cache_key, entry)
+    evict_cached_outputs(keep={cache_key, *keep})
+    output_cache.flush()
+    return entry
+
+def evict_cached_outputs(keep=()):
+    _, total = output_cache.usage()
+    if total <= CACHE_MAX_BYTES * CACHE_HIGH_WATERMARK:
+        return
+    
+    if CACHE_EVICTION_POLICY == "lfu":
+        order = lambda item: (item[1].get("hits", 0), item[1].get("last_access", item[1]["created"]))
+    else:
+        order = lambda item: item[1].get("last_access", item[1]["created"])
+    
+    target = CACHE_MAX_BYTES * CACHE_LOW_WATERMARK
+    for cache_key, entry in sorted(output_cache.items(), key=order):
+        if total <= target:
+            break
+        if serving_counts[cache_key]:
+            continue  # never pull a file out from under an active response
+        if cache_key in keep:
+            continue  # just stored and not hit yet, so LFU would otherwise always pick it first
+        path = os.path.join(CACHE_DIR, cache_key) if entry.get("package") else cache_path(cache_key, entry["filename"])
+        # Another worker may be evicting at the same time; whoever removes the entry deletes the files
+        if not output_cache.remove(cache_key):
+            continue
+        if entry.get("package"):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= entry["size"]
+        cache_stats["evictions"] += 1
+        cache_stats["evicted_bytes"] += entry["size"]
+        logger.info(f"Evicted cached output {cache_key} ({entry['size']} bytes)")
+
+async def process_audio_only(task_id: str, request: DownloadRequest):
+    task = task_store.get(task_id)
+    loop = asyncio.get_running_loop()
+    url = str(request.url)
+    audio_format = request.audio_format
+    cache_key = output_cache_key(get_video_id(url), request)
+    
+    logger.info(f"Starting audio-only download for task {task_id}: {url} as {audio_format}")
+    safe_title, stream = await loop.run_in_executor(
+        download_executor, resolve_audio_stream, task_id, url, audio_format, request.audio_bitrate)
+    
+    task.total_bytes = stream.filesize
+    task.downloaded_bytes = 0
+    audio_file = os.path.join(DOWNLOAD_DIR, f"{task_id}_{safe_title}_audio.{stream.subtype}")
+    await loop.run_in_executor(download_executor, download_stream, stream, audio_file, track_download_progress(task_id))
+    
+    task.status = "Processing"
+    extension = AUDIO_FORMATS[audio_format][3]
+    output_file = os.path.join(DOWNLOAD_DIR, f"{task_id}_{safe_title}{extension}")
+    task.processing_mode = await loop.run_in_executor(
+        transcode_executor, convert_audio, audio_file, output_file, audio_format, request.audio_bitrate,
+        task_id, task.duration)
+    os.remove(audio_file)
+    
+    filename = f"{safe_title}{extension}"
+    await loop.run_in_executor(download_executor, store_cached_output, cache_key, output_file, filename)
+    
+    logger.info(f"Processing completed for task {task_id}.")
+    profile = rendition_profile(request, audio_format)
+    task.filename = filename
+    task.cache_key = cache_key
+    task.renditions = {audio_format: {"filename": filename, "cache_key": cache_key, "profile": profile}}
+    task.encoder_profile = profile
+    # Status goes last: the store may flush and drop the task as soon as it is terminal
+    task.status = "Completed"
+
+async def process_clip(task_id: str, request: DownloadRequest, safe_title: str, video_stream, audio_stream,
+                       output_file: str, profile: dict):
+    task = task_store.get(task_id)
+    loop = asyncio.get_running_loop()
+    on_progress = track_download_progress(task_id)
+    start = request.start or 0.0
+    end = request.end if request.end is not None else float(task.duration or 0)
+    if task.duration and end > task.duration:
+        end = float(task.duration)
+    if end <= start:
+        raise ValueError(f"Clip end {end} must be after start {start}")
+    
+    # Work out which byte ranges cover the clip, then fetch only those
+    downloads = []
+    origins = []
+    files = []
+    task.total_bytes = 0
+    for kind, stream in (("video", video_stream), ("audio", audio_stream)):
+        if stream is None:
+            continue
+        plan = await loop.run_in_executor(download_executor, clip_byte_ranges, stream.url, start, end)
+        clip_file = os.path.join(DOWNLOAD_DIR, f"{task_id}_{safe_title}_{kind}_clip.{stream.subtype}")
+        files.append(clip_file)
+        if plan:
+            ranges, origin = plan
+            task.total_bytes += sum(last - first + 1 for first, last in ranges)
+            downloads.append(loop.run_in_executor(
+                download_executor, download_ranges, stream.url, clip_file, ranges, on_progress))
+        else:
+            logger.info(f"No sidx index for {kind} stream of task {task_id}, fetching it whole")
+            origin = 0.0
+            task.total_bytes += stream.filesize
+            downloads.append(loop.run_in_executor(download_executor, download_stream, stream, clip_file, on_progress))
+        origins.append(origin)
+    
+    logger.info(f"Fetching {task.total_bytes} bytes for {start}-{end}s clip of task {task_id}")
+    await asyncio.gather(*downloads)
+    
+    task.status = "Processing"
+    try:
+        mode = await loop.run_in_executor(
+            transcode_executor, cut_clip, files[0], files[1] if len(files) > 1 else None, output_file,
+            request.resolution, profile, start, end, origins[0], origins[1] if len(origins) > 1 else 0.0, task_id)
+    finally:
+        for clip_file in files:
+            os.remove(clip_file)
+    return mode
+
+async def process_package(task_id: str, request: DownloadRequest, renditions: dict):
+    task = task_store.get(task_id)
+    loop = asyncio.get_running_loop()
+    output_format = request.output_format
+    cache_key = package_cache_key(get_video_id(str(request.url)), request)
+    entry = lookup_cached_output(cache_key)
+    if entry is None:
+        task.status = "Processing"
+        sources = {resolution: cache_path(rendition["cache_key"]) for resolution, rendition in renditions.items()}
+        package_dir = os.path.join(DOWNLOAD_DIR, f"{task_id}_{output_format}")
+        logger.info(f"Packaging {', '.join(sources)} as {output_format} for task {task_id}")
+        # Keep the renditions from being evicted while they are read
+        for rendition in renditions.values():
+            serving_counts[rendition["cache_key"]] += 1
+        try:
+            manifest = await loop.run_in_executor(
+                transcode_executor, package_renditions, sources, output_format, package_dir)
+        finally:
+            for rendition in renditions.values():
+                serving_counts[rendition["cache_key"]] -= 1
+        # Moving the package and evicting for it touch the disk, so they stay off the event loop
+        entry = await loop.run_in_executor(
+            download_executor, store_cached_package, cache_key, package_dir, manifest, output_format,
+            [rendition["cache_key"] for rendition in renditions.values()])
+    return {"format": output_format, "cache_key": cache_key, "manifest": entry["filename"]}
+
+async def download_and_process_video(task_id: str, request: DownloadRequest):
+    task = task_store.get(task_id)
+    task.status = "Downloading"
+    loop = asyncio.get_running_loop()
+    url = str(request.url)
+    codec_preference = [request.codec] + CODEC_PREFERENCE if request.codec else CODEC_PREFERENCE
+    cache_keys = rendition_cache_keys(get_video_id(url), request)
+    live = None
+    
+    try:
+        if request.audio_format:
+            await process_audio_only(task_id, request)
+            return
+        
+        # Renditions already in the cache are not encoded again; when all of them are, the task
+        # completes straight from the cache
+        missing = [resolution for resolution, cache_key in cache_keys.items() if not lookup_cached_output(cache_key)]
+        profiles = {resolution: encoder_profile(resolution, request.preset, request.crf) for resolution in cache_keys}
+        task.encoder_profile = profiles[request.resolution]
+        
+        outputs = {}
+        if missing:
+            logger.info(f"Starting download for task {task_id}: {url}")
+            safe_title, video_stream, audio_stream = await loop.run_in_executor(
+                download_executor, resolve_streams, task_id, url, missing[0],
+                codec_preference, request.max_fps or MAX_FPS, request.video_only)
+            
+            task.total_bytes = video_stream.filesize + (audio_stream.filesize if audio_stream else 0)
+            task.downloaded_bytes = 0
+            outputs = {resolution: os.path.join(DOWNLOAD_DIR, f"{task_id}_{safe_title}_{resolution}.mp4")
+                       for resolution in missing}
+            
+            if PROGRESSIVE_DOWNLOADS and request.start is None and request.end is None:
+                # Aliases share the primary cache key, so they can find the outputs before the job completes
+                task.cache_key = cache_keys[request.resolution]
+                live = {"task_id": task_id, "resolution": request.resolution,
+                        "outputs": {resolution: [output_file, f"{safe_title}_{resolution}.mp4"]
+                                    for resolution, output_file in outputs.items()}}
+                task_store.set_live_outputs(task.cache_key, live)
+            
+            if request.start is not None or request.end is not None:
+                task.processing_mode = await process_clip(task_id, request, safe_title, video_stream, audio_stream,
+                                                          outputs[request.resolution], profiles[request.resolution])
+            elif (STREAMING_MODE
+                  # Long re-encodes go through a file so they can be split across the transcode pool
+                  and not await loop.run_in_executor(download_executor, wants_segmented_encode, outputs,
+                                                     task.duration, video_stream.url)
+                  and await loop.run_in_executor(download_executor, can_stream, video_stream, audio_stream)):
+                task.processing_mode = await stream_and_process(task_id, video_stream, audio_stream, outputs, profiles)
+            else:
+                task.processing_mode = await download_then_process(task_id, safe_title, video_stream, audio_stream,
+                                                                   outputs, profiles)
+        
+        renditions = {}
+        for resolution, cache_key in cache_keys.items():
+            if resolution in outputs:
+                filename = f"{safe_title}_{resolution}.mp4"
+                await loop.run_in_executor(download_executor, store_cached_output, cache_key,
+                                           outputs[resolution], filename, list(cache_keys.values()))
+            else:
+                filename = (output_cache.get(cache_key) or {}).get("filename")
+            renditions[resolution] = {"filename": filename, "cache_key": cache_key, "profile": profiles[resolution]}
+        
+        if request.output_format in PACKAGE_FORMATS:
+            task.package = await process_package(task_id, request, renditions)
         
         logger.info(f"Processing completed for task {task_id}.")
+        task.filename = renditions[request.resolution]["filename"]
+        task.cache_key = renditions[request.resolution]["cache_key"]
+        task.renditions = renditions
+        # Status goes last: the store may flush and drop the task as soon as it is terminal
         task.status = "Completed"
-        task.filename = os.path.basename(output_file)
     except Exception as e:
         logger.error(f"Error in task {task_id}: {str(e)}", exc_info=True)
-        task.status = "Failed"
         task.error = str(e)
+        task.status = "Failed"
+    finally:
+        if live:
+            task_store.clear_live_outputs(cache_keys[request.resolution], task_id)
+
+async def follow_output(task_id: str, output_file: str, cache_key: str, job_task_id: str):
+    # Yields the file as it grows until the job that writes it is done. Finished outputs are moved
+    # into the cache by rename, which leaves the open handle reading the same file
+    with open(output_file, "rb") as f:
+        while True:
+            finished = (task_store.live_outputs(cache_key) or {}).get("task_id") != job_task_id
+            chunk = await run_in_threadpool(f.read, 1024 * 1024)
+            if chunk:
+                yield chunk
+            elif finished:
+                break
+            else:
+                await asyncio.sleep(PROGRESSIVE_POLL_INTERVAL)
+    
+    # The response is chunked, so ending normally would pass a truncated file off as complete;
+    # raising makes the server abort the connection instead
+    task = task_store.get(task_id)
+    if task is None or task.status != "Completed":
+        raise RuntimeError(f"Encode for task {task_id} did not complete, aborting the progressive download")
+
+async def task_flusher():
+    # Batch task state writes instead of hitting the store on every progress update
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(TASK_FLUSH_INTERVAL)
+        try:
+            await loop.run_in_executor(None, task_store.flush)
+        except Exception as e:
+            logger.error(f"Error flushing task store: {str(e)}", exc_info=True)
+
+async def task_event_pump():
+    while True:
+        await asyncio.sleep(EVENT_PUSH_INTERVAL)
+        try:
+            task_events.publish_changes()
+        except Exception as e:
+            logger.error(f"Error publishing task events: {str(e)}", exc_info=True)
+
+def estimate_retry_after():
+    # Seconds until a worker is likely to pull the next job off a full queue
+    if recent_job_durations:
+        average = sum(recent_job_durations) / len(recent_job_durations)
+    else:
+        average = DEFAULT_JOB_DURATION
+    return max(1, math.ceil(average / MAX_CONCURRENT_JOBS))
+
+def attach_to_inflight(inflight_key: str):
+    # Returns a new alias task_id and the subscriber count if an identical job is already queued
+    # or running on any worker, else (None, 0)
+    primary_id = task_store.inflight_task(inflight_key)
+    if primary_id is None:
+        return None, 0
+    task_id = str(uuid.uuid4())
+    subscribers = task_store.add_alias(task_id, primary_id)
+    logger.info(f"Task {task_id} attached to in-flight task {primary_id} ({subscribers} subscribers)")
+    return task_id, subscribers
+
+def enqueue_job(task_id: str, request: DownloadRequest):
+    # Returns the subscriber count if an identical job claimed the job key first, possibly on
+    # another worker, and the task became its alias instead; else None
+    video_id = get_video_id(str(request.url))
+    primary_id = task_store.claim_inflight(job_key(video_id, request), task_id)
+    if primary_id != task_id:
+        subscribers = task_store.add_alias(task_id, primary_id)
+        task_store.finish_job(task_id)
+        logger.info(f"Task {task_id} attached to in-flight task {primary_id} ({subscribers} subscribers)")
+        return subscribers
+    queued_task_ids.append(task_id)
+    task_store.add(DownloadStatus(task_id=task_id, status="Queued", video_id=video_id, subscribers=1,
+                                  queue_position=len(queued_task_ids)))
+    job_queue.put_nowait((task_id, request))
+    task_store.journal_job(task_id, request.model_dump(mode="json"))
+    return None
+
+async def resume_journaled_jobs(journal: dict):
+    # Journaled jobs stay in the journal until they fit in the queue, however long that takes
+    for task_id, request in journal.items():
+        task_store.add(DownloadStatus(task_id=task_id, status="Queued", video_id=get_video_id(request["url"])))
+    for task_id, request in journal.items():
+        while job_queue.full():
+            await asyncio.sleep(1)
+        logger.info(f"Resuming journaled task {task_id}")
+        enqueue_job(task_id, DownloadRequest(**request))
+
+async def recover_orphaned_jobs():
+    # Resumes the journal left by the previous run at startup; with a shared task store, also the
+    # jobs of workers that died since
+    while True:
+        try:
+            journal = task_store.claim_orphaned_jobs()
+            if journal:
+                await resume_journaled_jobs(journal)
+        except Exception as e:
+            logger.error(f"Error recovering journaled jobs: {str(e)}", exc_info=True)
+        await asyncio.sleep(JOB_RECOVERY_INTERVAL)
+
+async def job_worker():
+    while True:
+        task_id, request = await job_queue.get()
+        queued_task_ids.remove(task_id)
+        # Positions live on the task records so aliases see them too
+        task_store.get(task_id).queue_position = None
+        for position, queued_id in enumerate(queued_task_ids, start=1):
+            task_store.get(queued_id).queue_position = position
+        started = time.monotonic()
+        try:
+            await download_and_process_video(task_id, request)
+            # Only finished jobs leave the journal; a crash mid-job leaves it there to be resumed
+            task_store.finish_job(task_id)
+        finally:
+            task_store.release_inflight(job_key(get_video_id(str(request.url)), request), task_id)
+            recent_job_durations.append(time.monotonic() - started)
+            job_queue.task_done()
+
+# Range responses
+MAX_RANGES = 16  # more ranges than this in one request are answered with the whole file
+
+def parse_range_header(header: str, file_size: int):
+    """Parse a Range header into sorted, merged (start, end) pairs.
+
+    Returns None when the header should be ignored and the whole file served, and an empty list
+    when none of the ranges can be satisfied.
+    """
+    if not header.startswith("bytes="):
+        return None
+    ranges = []
+    for spec in header[len("bytes="):].split(","):
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if first == "":
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(0, file_size - suffix), file_size - 1
+            else:
+                start = int(first)
+                end = min(int(last), file_size - 1) if last else file_size - 1
+                if start > end and start < file_size:
+                    return None
+        except ValueError:
+            return None
+        if start >= file_size:
+            continue
+        ranges.append((start, end))
+    
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+def content_disposition(filename: str):
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+class FileRangeResponse(Response):
+    """206 response for byte ranges of a file: one range as-is, several as multipart/byteranges.
+
+    File bytes go out through the ASGI zero-copy extension when the server offers it, and through
+    chunked reads otherwise.
+    """
+    chunk_size = 64 * 1024
+    
+    def __init__(self, path: str, ranges: list, file_size: int, media_type: str, headers: dict = None,
+                 background: BackgroundTask = None):
+        self.path = path
+        self.status_code = 206
+        self.background = background
+        headers = dict(headers or {})
+        
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            self.parts = [(b"", start, end)]
+            self.trailer = b""
+            self.media_type = media_type
+            headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+        else:
+            boundary = uuid.uuid4().hex
+            self.parts = []
+            for index, (start, end) in enumerate(ranges):
+                preamble = (("\r\n" if index else "") + f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+                            f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n").encode()
+                self.parts.append((preamble, start, end))
+            self.trailer = f"\r\n--{boundary}--\r\n".encode()
+            self.media_type = f"multipart/byteranges; boundary={boundary}"
+        
+        content_length = sum(len(preamble) + end - start + 1 for preamble, start, end in self.parts) + len(self.trailer)
+        headers["Content-Length"] = str(content_length)
+        self.init_headers(headers)
+    
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        zerocopy = "http.response.zerocopy" in scope.get("extensions", {})
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            for preamble, start, end in self.parts:
+                if preamble:
+                    await send({"type": "http.response.body", "body": preamble, "more_body": True})
+                if zerocopy:
+                    await send({"type": "http.response.zerocopy", "file": fd, "offset": start,
+                                "count": end - start + 1, "more_body": True})
+                    continue
+                offset = start
+                while offset <= end:
+                    chunk = await run_in_threadpool(os.pread, fd, min(self.chunk_size, end - offset + 1), offset)
+                    if not chunk:
+                        break
+                    offset += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": self.trailer, "more_body": False})
+        finally:
+            os.close(fd)
+        if self.background is not None:
+            await self.background()
 
 # API endpoints
+@app.on_event("startup")
+async def startup_event():
+    job_workers.append(asyncio.create_task(recover_orphaned_jobs()))
+    for _ in range(MAX_CONCURRENT_JOBS):
+        job_workers.append(asyncio.create_task(job_worker()))
+    job_workers.append(asyncio.create_task(task_flusher()))
+    job_workers.append(asyncio.create_task(task_event_pump()))
+    threading.Thread(target=apply_transcode_progress, name="transcode-progress", daemon=True).start()
+
 @app.post("/download")
-async def request_download(request: DownloadRequest, background_tasks: BackgroundTasks):
+async def request_download(request: DownloadRequest):
     try:
-        if request.resolution not in RESOLUTIONS:
-            raise HTTPException(status_code=400, detail=f"Invalid resolution. Supported resolutions are: {', '.join(RESOLUTIONS)}")
+        if request.audio_format:
+            if request.audio_format not in AUDIO_FORMATS:
+                raise HTTPException(status_code=400, detail=f"Invalid audio format. Supported formats are: {', '.join(AUDIO_FORMATS)}")
+        elif not request.resolution:
+            raise HTTPException(status_code=400, detail="Either resolution or audio_format is required")
+        else:
+            for resolution in requested_resolutions(request):
+                if resolution not in RESOLUTIONS:
+                    raise HTTPException(status_code=400, detail=f"Invalid resolution. Supported resolutions are: {', '.join(RESOLUTIONS)}")
+        
+        if request.start is not None or request.end is not None:
+            if request.audio_format or request.resolutions:
+                raise HTTPException(status_code=400, detail="Clips are only supported for single-resolution video downloads")
+            if (request.start or 0) < 0 or (request.end is not None and request.end <= (request.start or 0)):
+                raise HTTPException(status_code=400, detail="Clip start must be non-negative and before end")
+        
+        if request.output_format not in (None, "mp4", *PACKAGE_FORMATS):
+            raise HTTPException(status_code=400, detail=f"Invalid output format. Supported formats are: mp4, {', '.join(PACKAGE_FORMATS)}")
+        if request.output_format in PACKAGE_FORMATS and request.audio_format:
+            raise HTTPException(status_code=400, detail="Streaming packages are only supported for video downloads")
+        
+        if request.preset is not None and request.preset not in X264_PRESETS:
+            raise HTTPException(status_code=400, detail=f"Invalid preset. Supported presets are: {', '.join(X264_PRESETS)}")
+        if request.crf is not None and not 0 <= request.crf <= 51:
+            raise HTTPException(status_code=400, detail="Invalid crf. Must be between 0 and 51")
+        
+        video_id = get_video_id(str(request.url))
+        if not video_id:
+            raise HTTPException(status_code=400, detail="Invalid YouTube URL")
+        
+        # Back off to a faster preset while the queue is backing up, unless the caller chose one
+        adjusted = request
+        if request.preset is None and not request.audio_format:
+            preset = load_adjusted_preset(request.resolution)
+            if preset:
+                adjusted = request.model_copy(update={"preset": preset})
+        
+        # Outputs encoded under load are cached under the faster preset's keys, so look there too
+        for candidate in (request, adjusted):
+            cache_keys = rendition_cache_keys(video_id, candidate)
+            cached = {resolution: lookup_cached_output(cache_key) for resolution, cache_key in cache_keys.items()}
+            package = None
+            if candidate.output_format in PACKAGE_FORMATS:
+                package_key = package_cache_key(video_id, candidate)
+                cached["package"] = lookup_cached_output(package_key)
+                if cached["package"]:
+                    package = {"format": candidate.output_format, "cache_key": package_key,
+                               "manifest": cached["package"]["filename"]}
+            if all(cached.values()):
+                cache_stats["hits"] += 1
+                task_id = str(uuid.uuid4())
+                primary = primary_rendition(candidate)
+                profiles = {rendition: rendition_profile(candidate, rendition) for rendition in cache_keys}
+                renditions = {rendition: {"filename": cached[rendition]["filename"], "cache_key": cache_keys[rendition],
+                                          "profile": profiles[rendition]}
+                              for rendition in cache_keys}
+                task_store.add(DownloadStatus(task_id=task_id, status="Completed", video_id=video_id,
+                                              filename=cached[primary]["filename"], cache_key=cache_keys[primary],
+                                              renditions=renditions, package=package, encoder_profile=profiles[primary]))
+                logger.info(f"Cache hit for {request.url} at {', '.join(cache_keys)}, task {task_id}")
+                return JSONResponse(content={"task_id": task_id, "message": "Download ready", "cached": True})
+        cache_stats["misses"] += 1
+        
+        if adjusted is not request:
+            logger.info(f"Queue at {job_queue.qsize()}/{MAX_QUEUE_DEPTH}, encoding {request.url} with preset {adjusted.preset}")
+        
+        for candidate in (request, adjusted):
+            task_id, subscribers = attach_to_inflight(job_key(video_id, candidate))
+            if task_id:
+                return JSONResponse(content={"task_id": task_id, "message": "Attached to an identical download in progress",
+                                             "subscribers": subscribers})
+        request = adjusted
+        
+        if job_queue.full():
+            retry_after = estimate_retry_after()
+            logger.warning(f"Job queue full ({job_queue.qsize()} waiting), rejecting request for {request.url}")
+            raise HTTPException(status_code=429, detail="Too many pending downloads, try again later",
+                                headers={"Retry-After": str(retry_after)})
         
         task_id = str(uuid.uuid4())
-        download_tasks[task_id] = DownloadStatus(task_id=task_id, status="Queued")
         
-        logger.info(f"New download request: {request.url}, Resolution: {request.resolution}")
-        background_tasks.add_task(download_and_process_video, task_id, str(request.url), request.resolution)
+        logger.info(f"New download request: {request.url}, Resolution: {request.resolution}"
+                    + (f", Audio: {request.audio_format}" if request.audio_format else ""))
+        subscribers = enqueue_job(task_id, request)
+        if subscribers:
+            return JSONResponse(content={"task_id": task_id, "message": "Attached to an identical download in progress",
+                                         "subscribers": subscribers})
         
-        return JSONResponse(content={"task_id": task_id, "message": "Download request accepted"})
+        return JSONResponse(content={"task_id": task_id, "message": "Download request accepted",
+                                     "queue_position": len(queued_task_ids)})
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in request_download: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 @app.get("/status/{task_id}")
 async def get_status(task_id: str):
-    task = download_tasks.get(task_id)
+    task = task_store.get(task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     return task
 
+@app.get("/videos/{video_id}/tasks")
+async def get_video_tasks(video_id: str, limit: int = 100):
+    # Most recent first; aliases are left out, they share their primary's record
+    if not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="Invalid limit. Must be between 1 and 1000")
+    return task_store.find_by_video_id(video_id, limit)
+
+@app.get("/status/{task_id}/events")
+async def stream_status_events(task_id: str):
+    if not task_store.get(task_id):
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    async def event_stream():
+        queue = task_events.subscribe(task_id)
+        try:
+            while True:
+                try:
+                    status, payload = await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {payload}\n\n"
+                if status in TERMINAL_STATUSES:
+                    break
+        finally:
+            task_events.unsubscribe(task_id, queue)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/status/{task_id}/ws")
+async def status_websocket(websocket: WebSocket, task_id: str):
+    await websocket.accept()
+    if not task_store.get(task_id):
+        await websocket.close(code=4404, reason="Task not found")
+        return
+    
+    queue = task_events.subscribe(task_id)
+    # Wait on the client too, so a watcher that goes away while the task is idle is dropped right away
+    # rather than on the next state change
+    receiver = asyncio.ensure_future(websocket.receive())
+    update = asyncio.ensure_future(queue.get())
+    try:
+        while True:
+            await asyncio.wait({receiver, update}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver.done():
+                if receiver.result()["type"] == "websocket.disconnect":
+                    return
+                receiver = asyncio.ensure_future(websocket.receive())  # nothing to answer, keep listening
+                continue
+            status, payload = update.result()
+            await websocket.send_text(payload)
+            if status in TERMINAL_STATUSES:
+                break
+            update = asyncio.ensure_future(queue.get())
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        update.cancel()
+        task_events.unsubscribe(task_id, queue)
+
 @app.get("/download/{task_id}")
-async def download_file(task_id: str):
-    task = download_tasks.get(task_id)
+async def download_file(task_id: str, request: Request, resolution: str = None):
+    task = task_store.get(task_id)
+    live = (task_store.live_outputs(task.cache_key)
+            if task and task.cache_key and task.status not in TERMINAL_STATUSES else None)
+    if live:
+        # Still encoding: send the fragments written so far and keep following the file
+        output_file, filename = live["outputs"].get(resolution or live["resolution"], (None, None))
+        if output_file is None or not os.path.exists(output_file):
+            raise HTTPException(status_code=404, detail="Download not ready or doesn't exist")
+        logger.info(f"Serving {filename} for task {task_id} while it is being encoded")
+        return StreamingResponse(follow_output(task_id, output_file, task.cache_key, live["task_id"]), media_type="video/mp4",
+                                 headers={"Content-Disposition": content_disposition(filename)})
+    
     if not task or task.status != "Completed":
         raise HTTPException(status_code=404, detail="Download not ready or doesn't exist")
     
-    file_path = os.path.join(DOWNLOAD_DIR, task.filename)
-    return FileResponse(file_path, media_type="video/mp4", filename=task.filename)
+    cache_key, filename = task.cache_key, task.filename
+    if resolution:
+        rendition = (task.renditions or {}).get(resolution)
+        if rendition is None:
+            raise HTTPException(status_code=404, detail=f"No {resolution} rendition for this task")
+        cache_key, filename = rendition["cache_key"], rendition["filename"]
+    
+    file_path = cache_path(cache_key, filename)
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Download has expired from the cache")
+    
+    # The same cache key can hold different bytes (another encode path, or a re-encode after
+    # eviction), so the validator also covers the file that is on disk now
+    etag = f'"{cache_key}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    headers = {"ETag": etag, "Last-Modified": last_modified, "Accept-Ranges": "bytes"}
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    
+    ranges = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() in (etag, last_modified)):
+        ranges = parse_range_header(range_header, stat.st_size)
+        if ranges == []:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+    
+    output_cache.touch(cache_key)
+    serving_counts[cache_key] += 1
+    
+    def release():
+        serving_counts[cache_key] -= 1
+    
+    media_type = MEDIA_TYPES.get(os.path.splitext(filename)[1], "application/octet-stream")
+    if ranges:
+        headers["Content-Disposition"] = content_disposition(filename)
+        return FileRangeResponse(file_path, ranges, stat.st_size, media_type, headers=headers,
+                                 background=BackgroundTask(release))
+    return FileResponse(file_path, media_type=media_type, filename=filename, headers=headers,
+                        stat_result=stat, background=BackgroundTask(release))
+
+@app.get("/package/{task_id}/{path:path}")
+async def package_file(task_id: str, path: str, request: Request):
+    task = task_store.get(task_id)
+    if not task or task.status != "Completed" or not task.package:
+        raise HTTPException(status_code=404, detail="Package not ready or doesn't exist")
+    
+    cache_key = task.package["cache_key"]
+    package_dir = cache_path(cache_key)
+    file_path = os.path.normpath(os.path.join(package_dir, path))
+    if not file_path.startswith(package_dir + os.sep) or not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="No such file in this package")
+    
+    # Clients and CDNs cache every segment on its own, so a seek only costs the segments it lands
+    # on. As with downloads, the validator covers the file on disk in case the package was rebuilt
+    stat = os.stat(file_path)
+    etag = '"' + hashlib.sha256(f"{cache_key}/{path}".encode()).hexdigest()[:32] + f'-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    
+    # A playback session fetches the manifest once and then many segments; only the former is a hit
+    output_cache.touch(cache_key, hit=path == task.package["manifest"])
+    serving_counts[cache_key] += 1
+    
+    def release():
+        serving_counts[cache_key] -= 1
+    
+    media_type = MEDIA_TYPES.get(os.path.splitext(file_path)[1], "application/octet-stream")
+    return FileResponse(file_path, media_type=media_type, headers=headers, stat_result=stat,
+                        background=BackgroundTask(release))
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    entries, used_bytes = output_cache.usage()
+    return dict(cache_stats, entries=entries, used_bytes=used_bytes,
+                max_bytes=CACHE_MAX_BYTES, policy=CACHE_EVICTION_POLICY, metadata=video_metadata.summary(),
+                players=player_cache.summary())
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    for file in os.listdir(DOWNLOAD_DIR):
-        os.remove(os.path.join(DOWNLOAD_DIR, file))
-    os.rmdir(DOWNLOAD_DIR)
+    for worker in job_workers:
+        worker.cancel()
+    download_executor.shutdown(wait=False, cancel_futures=True)
+    transcode_executor.shutdown(wait=False, cancel_futures=True)
+    progress_queue.put(None)
+    # Keep partial downloads of unfinished jobs, this worker's or another's, so they can resume.
+    # Jobs are journaled before they create files, so the journal is read after listing them;
+    # the directory itself stays in case another worker is still writing to it
+    files = os.listdir(DOWNLOAD_DIR)
+    journaled = task_store.journaled_task_ids()
+    task_store.close()
+    for file in files:
+        if not any(file.startswith(task_id) for task_id in journaled):
+            path = os.path.join(DOWNLOAD_DIR, file)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
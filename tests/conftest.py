@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# main.py creates its working directories and task database relative to the current directory
+# on import, so tests run it from a scratch directory with a process-local task store
+os.chdir(tempfile.mkdtemp(prefix="youtufy-tests-"))
+os.environ.setdefault("TASK_STORE", "memory")
+os.environ.setdefault("TRANSCODE_WORKERS", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
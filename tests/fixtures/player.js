@@ -0,0 +1,5 @@
+var DE={AJ:function(a){a.reverse()}, VR:function(a,b){a.splice(0,b)}, kT:function(a,b){var c=a[0];a[0]=a[b%a.length];a[b%a.length]=c}};
+Xy=function(a){a=a.split("");DE.AJ(a,15);DE.VR(a,3);DE.kT(a,5);return a.join("")};
+var Bpa=[Nq];
+Nq=function(a){var b=a.split(""),c=[1,"x",function(d){d.reverse()},null,b,function(d,e){d.push(e)}];try{c[2](c[4]);c[5](c[4],c[1]);c[2](c[3])}catch(f){return"enhanced_except_"+a}return b.join("")};
+g.h=function(a){a.D&&(b=a.get("n"))&&(b=Bpa[0](b),a.set("n",b))};
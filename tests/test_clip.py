@@ -0,0 +1,87 @@
+import shutil
+import subprocess
+
+import ffmpeg
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")),
+                                reason="needs ffmpeg and ffprobe")
+
+FPS = 10
+
+
+def fragmented_source(path, source, *codec_args):
+    # Laid out like a YouTube DASH stream: ftyp, moov, sidx, then one fragment per keyframe
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", source, *codec_args,
+                    "-f", "mp4", "-movflags", "dash+global_sidx", path], check=True)
+    return path
+
+
+def fetch_clip_ranges(monkeypatch, source, start, end, dest):
+    # What process_clip downloads: the init segment plus the subsegments covering start..end
+    with open(source, "rb") as f:
+        data = f.read()
+
+    class Response:
+        def __init__(self, content):
+            self.content = content
+
+        def raise_for_status(self):
+            pass
+
+    def get(url, headers, timeout):
+        first, last = (int(n) for n in headers["Range"][len("bytes="):].split("-"))
+        return Response(data[first:last + 1])
+
+    monkeypatch.setattr(main.http_session, "get", get)
+    ranges, origin = main.clip_byte_ranges(source, start, end)
+    with open(dest, "wb") as f:
+        for first, last in ranges:
+            f.write(data[first:last + 1])
+    return origin
+
+
+# Flat frames that encode their own number: the second in the blue difference, the frame within it
+# in the luma, in steps large enough to survive compression
+NUMBERED_FRAMES = "geq=lum='20+mod(N,10)*20':cb='16+floor(N/10)*20':cr=128"
+
+
+def first_frame_number(video_file):
+    pixels, _ = (ffmpeg.input(video_file)
+                 .output("pipe:", vframes=1, vf="crop=16:16", format="rawvideo", pix_fmt="yuv420p")
+                 .run(capture_stdout=True, capture_stderr=True))
+    luma, blue = sum(pixels[:256]) / 256, sum(pixels[256:320]) / 64
+    return round((blue - 16) / 20) * FPS + round((luma - 20) / 20)
+
+
+def reads_mpegts(tmp_path):
+    # Some static ffmpeg builds crash demuxing MPEG-TS, which the smart cut joins its parts as
+    part = str(tmp_path / "probe.ts")
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc=d=0.2", part], check=True)
+    return subprocess.run(["ffmpeg", "-v", "error", "-i", part, "-f", "null", "-"]).returncode == 0
+
+
+@pytest.mark.parametrize("size, mode", [("854x480", "clip-smartcut"), ("640x360", "clip")])
+def test_clip_of_partially_downloaded_fragments_starts_at_the_requested_time(tmp_path, monkeypatch, size, mode):
+    if mode == "clip-smartcut" and not reads_mpegts(tmp_path):
+        pytest.skip("this ffmpeg build cannot read MPEG-TS")
+    video = fragmented_source(str(tmp_path / "video.mp4"),
+                              f"color=c=black:s={size}:r={FPS}:d=10,format=yuv420p,{NUMBERED_FRAMES}",
+                              "-c:v", "libx264", "-g", str(FPS), "-sc_threshold", "0")
+    audio = fragmented_source(str(tmp_path / "audio.m4a"), "sine=frequency=440:duration=10", "-c:a", "aac")
+    start, end = 4.5, 6.5
+    video_origin = fetch_clip_ranges(monkeypatch, video, start, end, str(tmp_path / "video_clip.mp4"))
+    audio_origin = fetch_clip_ranges(monkeypatch, audio, start, end, str(tmp_path / "audio_clip.m4a"))
+    assert video_origin == 4.0
+
+    output = str(tmp_path / "clip.mp4")
+    assert main.cut_clip(str(tmp_path / "video_clip.mp4"), str(tmp_path / "audio_clip.m4a"), output, "480p",
+                         main.encoder_profile("480p"), start, end, video_origin, audio_origin) == mode
+
+    assert first_frame_number(output) == start * FPS
+    streams = {stream["codec_type"]: stream for stream in ffmpeg.probe(output)["streams"]}
+    # A stream-copied tail can run on by the source's reordering delay, two frames here
+    assert end - start - 0.15 <= float(streams["video"]["duration"]) <= end - start + 2 / FPS + 0.05
+    assert float(streams["audio"]["duration"]) == pytest.approx(end - start, abs=0.15)
@@ -0,0 +1,65 @@
+import os
+
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+def completed_task(task_id, cache_key, data):
+    filename = "video_720p.mp4"
+    with open(main.cache_path(cache_key, filename), "wb") as f:
+        f.write(data)
+    main.output_cache.put(cache_key, {"filename": filename, "size": len(data), "created": 0, "last_access": 0, "hits": 0})
+    main.task_store.add(main.DownloadStatus(task_id=task_id, status="Completed", filename=filename, cache_key=cache_key,
+                                            renditions={"720p": {"filename": filename, "cache_key": cache_key}}))
+    return main.cache_path(cache_key, filename)
+
+
+def test_range_and_conditional_requests():
+    completed_task("range-task", "rangekey", bytes(range(100)))
+
+    full = client.get("/download/range-task")
+    assert full.status_code == 200 and full.content == bytes(range(100))
+    etag = full.headers["etag"]
+    assert etag.startswith('"rangekey-')
+
+    assert client.get("/download/range-task", headers={"If-None-Match": etag}).status_code == 304
+
+    partial = client.get("/download/range-task", headers={"Range": "bytes=10-19"})
+    assert partial.status_code == 206
+    assert partial.headers["content-range"] == "bytes 10-19/100"
+    assert partial.content == bytes(range(10, 20))
+
+    multi = client.get("/download/range-task", headers={"Range": "bytes=0-1,-2"})
+    assert multi.status_code == 206
+    assert multi.headers["content-type"].startswith("multipart/byteranges")
+    assert "Content-Range: bytes 98-99/100" in multi.content.decode("latin-1")
+
+    unsatisfiable = client.get("/download/range-task", headers={"Range": "bytes=200-"})
+    assert unsatisfiable.status_code == 416
+    assert unsatisfiable.headers["content-range"] == "bytes */100"
+
+
+def test_etag_changes_when_the_cached_file_is_replaced():
+    path = completed_task("replaced-task", "replacedkey", b"a" * 50)
+    etag = client.get("/download/replaced-task").headers["etag"]
+
+    with open(path, "wb") as f:
+        f.write(b"b" * 60)
+    os.utime(path, ns=(0, 1))
+    resumed = client.get("/download/replaced-task", headers={"Range": "bytes=40-", "If-Range": etag})
+    assert resumed.status_code == 200
+    assert resumed.content == b"b" * 60
+    assert resumed.headers["etag"] != etag
+
+
+def test_tasks_are_listed_by_video():
+    for task_id in ("video-first", "video-second"):
+        main.task_store.add(main.DownloadStatus(task_id=task_id, status="Completed", video_id="ccccccccccc"))
+
+    listed = client.get("/videos/ccccccccccc/tasks")
+    assert listed.status_code == 200
+    assert [task["task_id"] for task in listed.json()] == ["video-second", "video-first"]
+    assert client.get("/videos/ccccccccccc/tasks", params={"limit": 0}).status_code == 400
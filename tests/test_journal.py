@@ -0,0 +1,38 @@
+import asyncio
+
+import main
+
+
+def test_journaled_jobs_wait_for_room_instead_of_being_dropped(tmp_path, monkeypatch):
+    journal = {
+        "journal-a": {"url": "https://www.youtube.com/watch?v=aaaaaaaaaaa", "resolution": "720p"},
+        "journal-b": {"url": "https://www.youtube.com/watch?v=bbbbbbbbbbb", "resolution": "480p"},
+    }
+    monkeypatch.setattr(main, "JOB_JOURNAL", str(tmp_path / "pending_jobs.json"))
+    main.write_json_atomic(main.JOB_JOURNAL, journal)
+    monkeypatch.setattr(main, "task_store", main.MemoryTaskStore())
+    monkeypatch.setattr(main, "queued_task_ids", main.deque())
+
+    async def scenario():
+        monkeypatch.setattr(main, "job_queue", asyncio.Queue(maxsize=1))
+        assert main.task_store.claim_orphaned_jobs() == journal
+        assert main.task_store.claim_orphaned_jobs() == {}
+        resumer = asyncio.create_task(main.resume_journaled_jobs(journal))
+        await asyncio.sleep(0.1)
+        # Only the first fits; the second is still journaled and its record is Queued, not stale
+        assert main.job_queue.qsize() == 1
+        assert main.task_store.journaled_task_ids() == {"journal-a", "journal-b"}
+        assert main.task_store.get("journal-b").status == "Queued"
+
+        first, _ = main.job_queue.get_nowait()
+        await asyncio.wait_for(resumer, timeout=3)
+        second, _ = main.job_queue.get_nowait()
+        return first, second
+
+    assert asyncio.run(scenario()) == ("journal-a", "journal-b")
+
+
+def test_journaled_requests_round_trip():
+    request = main.DownloadRequest(url="https://www.youtube.com/watch?v=aaaaaaaaaaa", resolution="720p")
+    # The journal stores model_dump output, unset options included as nulls
+    assert main.DownloadRequest(**request.model_dump(mode="json")) == request
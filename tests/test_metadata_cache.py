@@ -0,0 +1,58 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from pytube.exceptions import VideoUnavailable
+
+import main
+
+
+class FakeYouTube:
+    lookups = 0
+    expire = None
+
+    def __init__(self, url):
+        FakeYouTube.lookups += 1
+        video_id = url.rsplit("=", 1)[1]
+        if video_id == "gone":
+            raise VideoUnavailable(video_id)
+        self.js_url = "https://www.youtube.com/s/player/0123abcd/base.js"
+        self.title = "A video"
+        self.length = 90
+        self.streams = [SimpleNamespace(url=f"https://example.com/videoplayback?expire={FakeYouTube.expire}&itag=18")]
+
+
+@pytest.fixture
+def metadata(monkeypatch):
+    FakeYouTube.lookups = 0
+    monkeypatch.setattr(main, "YouTube", FakeYouTube)
+    monkeypatch.setattr(main.player_cache, "script", lambda js_url: "")
+    return main.VideoMetadataCache()
+
+
+def test_entries_expire_before_their_signed_urls(metadata):
+    FakeYouTube.expire = int(time.time()) + main.METADATA_EXPIRY_MARGIN + 60
+    yt = metadata.get("abc")
+    assert metadata.get("abc") is yt
+    assert FakeYouTube.lookups == 1
+    expires_at, _ = metadata.entries["abc"]
+    assert expires_at <= FakeYouTube.expire - main.METADATA_EXPIRY_MARGIN
+    assert metadata.summary()["hit_rate"] == 0.5
+    assert metadata.resolving == {}
+
+
+def test_urls_about_to_expire_are_not_cached(metadata):
+    FakeYouTube.expire = int(time.time()) + main.METADATA_EXPIRY_MARGIN - 1
+    metadata.get("abc")
+    metadata.get("abc")
+    assert FakeYouTube.lookups == 2
+    assert "abc" not in metadata.entries
+
+
+def test_unavailable_videos_are_negative_cached(metadata):
+    for _ in range(2):
+        with pytest.raises(VideoUnavailable):
+            metadata.get("gone")
+    assert FakeYouTube.lookups == 1
+    assert metadata.stats["negative_hits"] == 1
+    assert metadata.resolving == {}
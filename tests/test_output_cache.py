@@ -0,0 +1,40 @@
+import main
+
+
+def test_lfu_keeps_the_output_it_just_stored(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "output_cache", main.CacheIndex(str(tmp_path / "index.json")))
+    monkeypatch.setattr(main, "CACHE_EVICTION_POLICY", "lfu")
+    monkeypatch.setattr(main, "CACHE_MAX_BYTES", 150)
+    (tmp_path / "popular.mp4").write_bytes(b"x" * 100)
+    main.output_cache.put("popular", {"filename": "popular.mp4", "size": 100, "created": 1.0,
+                                      "last_access": 1.0, "hits": 5})
+
+    output_file = tmp_path / "encoded.mp4"
+    output_file.write_bytes(b"y" * 100)
+    main.store_cached_output("new", str(output_file), "new.mp4")
+
+    assert main.lookup_cached_output("new") is not None
+    assert main.output_cache.get("popular") is None
+    assert not (tmp_path / "popular.mp4").exists()
+
+
+def test_earlier_renditions_of_the_same_job_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "output_cache", main.CacheIndex(str(tmp_path / "index.json")))
+    monkeypatch.setattr(main, "CACHE_EVICTION_POLICY", "lfu")
+    monkeypatch.setattr(main, "CACHE_MAX_BYTES", 150)
+    for cache_key in ("720p", "480p"):
+        output_file = tmp_path / f"{cache_key}.out"
+        output_file.write_bytes(b"z" * 100)
+        main.store_cached_output(cache_key, str(output_file), f"video_{cache_key}.mp4", keep=["720p", "480p"])
+
+    assert main.lookup_cached_output("720p") is not None
+    assert main.lookup_cached_output("480p") is not None
+
+
+def test_cache_key_depends_on_the_requested_codec():
+    url = "https://www.youtube.com/watch?v=aaaaaaaaaaa"
+    keys = {codec: main.output_cache_key("aaaaaaaaaaa", main.DownloadRequest(url=url, resolution="720p", codec=codec))
+            for codec in (None, "avc1", "vp9")}
+    assert len(set(keys.values())) == 3
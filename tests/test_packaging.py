@@ -0,0 +1,32 @@
+import os
+import re
+import shutil
+import subprocess
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.skipif(not (shutil.which("ffmpeg") and shutil.which("ffprobe")),
+                                reason="needs ffmpeg and ffprobe")
+
+
+def test_hls_variants_advertise_measured_bandwidth_and_codecs(tmp_path):
+    source = str(tmp_path / "video_480p.mp4")
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi", "-i", "testsrc=s=854x480:r=25:d=8",
+                    "-f", "lavfi", "-i", "sine=frequency=440:duration=8", "-c:v", "libx264", "-pix_fmt", "yuv420p", "-profile:v", "main",
+                    "-level", "3.1", "-g", "50", "-c:a", "aac", "-fflags", "+bitexact", "-shortest", source], check=True)
+
+    package_dir = str(tmp_path / "package")
+    assert main.package_renditions({"480p": source}, "hls", package_dir) == "master.m3u8"
+    with open(os.path.join(package_dir, "master.m3u8")) as f:
+        master = f.read()
+
+    attributes = dict(re.findall(r'([A-Z-]+)=("[^"]*"|[^,\n]+)', master.split("#EXT-X-STREAM-INF:")[1]))
+    peak, average = int(attributes["BANDWIDTH"]), int(attributes["AVERAGE-BANDWIDTH"])
+    segments = [name for name in os.listdir(os.path.join(package_dir, "480p")) if name.endswith(".m4s")]
+    total_bits = sum(os.path.getsize(os.path.join(package_dir, "480p", name)) * 8 for name in segments)
+    duration = 8
+    assert average == pytest.approx(total_bits / duration, rel=0.1)
+    assert peak >= average > 0
+    assert attributes["CODECS"] == '"avc1.4D001F,mp4a.40.2"'
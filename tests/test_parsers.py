@@ -0,0 +1,102 @@
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-9", [(0, 9)]),
+    ("bytes=90-", [(90, 99)]),
+    ("bytes=-5", [(95, 99)]),
+    ("bytes=50-500", [(50, 99)]),
+    ("bytes=0-10,5-20,21-30,40-49", [(0, 30), (40, 49)]),
+    ("bytes=200-", []),
+    ("bytes=-0", []),
+    ("items=0-9", None),
+    ("bytes=5-3", None),
+    ("bytes=a-b", None),
+    ("bytes=" + ",".join(f"{n * 5}-{n * 5 + 1}" for n in range(17)), None),
+])
+def test_parse_range_header(header, expected):
+    assert main.parse_range_header(header, 100) == expected
+
+
+def sidx_box(references, timescale=1000, earliest=0, first_offset=0):
+    # version 0 sidx: (size, duration in timescale units) per reference
+    body = struct.pack(">BxxxIIII", 0, 1, timescale, earliest, first_offset)
+    body += struct.pack(">HH", 0, len(references))
+    for size, duration in references:
+        body += struct.pack(">III", size, duration, 0x90000000)
+    return struct.pack(">I4s", 8 + len(body), b"sidx") + body
+
+
+def test_parse_sidx_covers_only_the_requested_subsegments():
+    sidx = sidx_box([(1000, 2000), (1500, 2000), (800, 2000)])
+    base = 600 + len(sidx)
+    assert main.parse_sidx(sidx, 600, 2.5, 3.5) == ([(base + 1000, base + 2499)], 2.0)
+    assert main.parse_sidx(sidx, 600, 1.0, 4.5) == ([(base, base + 3299)], 0.0)
+    assert main.parse_sidx(sidx, 600, 7.0, 8.0) is None
+
+
+def test_parse_sidx_honours_earliest_time_and_first_offset():
+    sidx = sidx_box([(1000, 2000), (1000, 2000)], timescale=1000, earliest=10000, first_offset=50)
+    base = len(sidx) + 50
+    assert main.parse_sidx(sidx, 0, 12.5, 13.0) == ([(base + 1000, base + 1999)], 12.0)
+
+
+class Streams(list):
+    def filter(self, adaptive=None, only_video=None):
+        return Streams(self)
+
+
+def stream(resolution, codec="avc1.640028", fps=30, filesize=1000):
+    return SimpleNamespace(resolution=resolution, video_codec=codec, fps=fps, filesize=filesize, itag=0)
+
+
+def test_select_video_stream_takes_the_smallest_covering_resolution():
+    streams = Streams([stream("2160p"), stream("1080p"), stream("720p"), stream(None)])
+    chosen, reason = main.select_video_stream(streams, "900p", main.CODEC_PREFERENCE, 60)
+    assert chosen.resolution == "1080p"
+    assert "1080p" in reason
+
+
+def test_select_video_stream_falls_back_to_the_best_available():
+    streams = Streams([stream("480p"), stream("720p")])
+    chosen, reason = main.select_video_stream(streams, "1080p", main.CODEC_PREFERENCE, 60)
+    assert chosen.resolution == "720p"
+    assert "no stream reaches 1080p" in reason
+
+
+def test_select_video_stream_applies_codec_preference_and_fps_cap():
+    av1 = stream("1080p", codec="av01.0.08M.08", fps=30)
+    vp9_60 = stream("1080p", codec="vp9", fps=60)
+    vp9_30 = stream("1080p", codec="vp9", fps=30, filesize=900)
+    streams = Streams([av1, vp9_60, vp9_30])
+    assert main.select_video_stream(streams, "1080p", ["vp9", "av01"], 60)[0] is vp9_60
+    assert main.select_video_stream(streams, "1080p", ["vp9", "av01"], 30)[0] is vp9_30
+    assert main.select_video_stream(streams, "1080p", ["av01", "vp9"], 60)[0] is av1
+
+
+def test_select_video_stream_without_candidates():
+    assert main.select_video_stream(Streams([stream(None)]), "720p", main.CODEC_PREFERENCE, 60)[0] is None
+
+
+@pytest.mark.parametrize("queued, resolution, expected", [
+    (0, "1080p", None),
+    (25, "1080p", "veryfast"),
+    (40, "1080p", "ultrafast"),
+    (25, "2160p", "veryfast"),
+])
+def test_load_adjusted_preset(monkeypatch, queued, resolution, expected):
+    monkeypatch.setattr(main, "MAX_QUEUE_DEPTH", 50)
+    monkeypatch.setattr(main, "LOAD_PRESET_STEPS", [(0.8, "ultrafast"), (0.5, "veryfast")])
+    monkeypatch.setattr(main, "job_queue", SimpleNamespace(qsize=lambda: queued))
+    assert main.load_adjusted_preset(resolution) == expected
+
+
+def test_load_adjusted_preset_never_slows_an_encode_down(monkeypatch):
+    monkeypatch.setattr(main, "LOAD_PRESET_STEPS", [(0.5, "medium")])
+    monkeypatch.setattr(main, "job_queue", SimpleNamespace(qsize=lambda: main.MAX_QUEUE_DEPTH))
+    assert main.load_adjusted_preset("2160p") is None
@@ -0,0 +1,45 @@
+import os
+import shutil
+
+from pytube.cipher import Cipher
+
+import main
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "player.js")
+JS_URL = "https://www.youtube.com/s/player/0123abcd/player_ias.vflset/en_US/base.js"
+
+
+def player_cache(tmp_path):
+    shutil.copy(FIXTURE, tmp_path / "0123abcd.js")
+    return main.PlayerCache(str(tmp_path))
+
+
+def test_plan_round_trips_through_disk(tmp_path):
+    with open(FIXTURE) as f:
+        expected = Cipher(js=f.read())
+
+    first = player_cache(tmp_path)
+    js = first.script(JS_URL)
+    built = first.cipher(js)
+    assert first.stats["plan_builds"] == 1
+    assert os.path.exists(tmp_path / "0123abcd.json")
+
+    second = main.PlayerCache(str(tmp_path))
+    loaded = second.cipher(second.script(JS_URL))
+    assert second.stats["plan_builds"] == 0
+    assert loaded.throttling_array[3] is loaded.throttling_array
+
+    for cipher in (built, loaded):
+        assert cipher.get_signature("abcdefghijklmnop") == expected.get_signature("abcdefghijklmnop")
+    assert loaded.calculate_n(list("abc")) == expected.calculate_n(list("abc"))
+
+
+def test_each_use_gets_its_own_throttling_array(tmp_path):
+    cache = player_cache(tmp_path)
+    js = cache.script(JS_URL)
+    # The fixture's throttling plan reverses the array through its self-reference
+    assert cache.cipher(js).calculate_n(list("abc")) == "cbax"
+    assert cache.cipher(js).calculate_n(list("def")) == "fedx"
+    template = cache.plans["0123abcd"]
+    assert template.throttling_array[3] is template.throttling_array
+    assert template.throttling_array[4] == "b"
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+async def collect(task_id, output_file, finish_status):
+    live = {"task_id": task_id, "resolution": "720p", "outputs": {"720p": [output_file, "video_720p.mp4"]}}
+    main.task_store.set_live_outputs("key", live)
+    chunks = []
+    follower = main.follow_output(task_id, output_file, "key", task_id)
+    chunks.append(await follower.__anext__())
+    with open(output_file, "ab") as f:
+        f.write(b"second")
+    task = main.task_store.get(task_id)
+    if finish_status == "Failed":
+        task.error = "ffmpeg exited with 1"
+    task.status = finish_status
+    main.task_store.clear_live_outputs("key", task_id)
+    async for chunk in follower:
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+@pytest.mark.parametrize("status", ["Completed", "Failed"])
+def test_follow_output_ends_according_to_the_encode(tmp_path, monkeypatch, status):
+    monkeypatch.setattr(main, "PROGRESSIVE_POLL_INTERVAL", 0.01)
+    task_id = f"follow-{status}"
+    main.task_store.add(main.DownloadStatus(task_id=task_id, status="Processing"))
+    output_file = str(tmp_path / "video.mp4")
+    with open(output_file, "wb") as f:
+        f.write(b"first")
+
+    if status == "Completed":
+        assert asyncio.run(collect(task_id, output_file, status)) == b"firstsecond"
+    else:
+        with pytest.raises(RuntimeError):
+            asyncio.run(collect(task_id, output_file, status))
+
+
+def test_followers_on_another_worker_wait_for_the_terminal_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "PROGRESSIVE_POLL_INTERVAL", 0.01)
+    database = str(tmp_path / "tasks.db")
+    encoder, server = main.SQLiteTaskStore(database), main.SQLiteTaskStore(database)
+    monkeypatch.setattr(main, "task_store", server)
+    output_file = str(tmp_path / "video.mp4")
+    with open(output_file, "wb") as f:
+        f.write(b"first")
+    task = main.DownloadStatus(task_id="shared", status="Processing", cache_key="key")
+    encoder.add(task)
+    encoder.set_live_outputs("key", {"task_id": "shared", "resolution": "720p",
+                                     "outputs": {"720p": [output_file, "video_720p.mp4"]}})
+    encoder.flush()
+
+    async def scenario():
+        follower = main.follow_output("shared", output_file, "key", "shared")
+        chunks = [await follower.__anext__()]
+        with open(output_file, "ab") as f:
+            f.write(b"second")
+        task.status = "Completed"
+        encoder.clear_live_outputs("key", "shared")
+        chunks.append(await follower.__anext__())
+        # The encoding worker has not written the terminal state yet, so the follower keeps waiting
+        waiting = asyncio.ensure_future(follower.__anext__())
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        encoder.flush()
+        with pytest.raises(StopAsyncIteration):
+            await waiting
+        return b"".join(chunks)
+
+    assert asyncio.run(scenario()) == b"firstsecond"
+    encoder.close()
+    server.close()
@@ -0,0 +1,151 @@
+import json
+import os
+import re
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import main
+
+CHUNK_SIZE = 1000
+FIXTURE = os.urandom(4500)
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves FIXTURE with single byte-range support; server.failures[start] makes that range fail
+    and server.ignore_ranges answers every request with the whole file."""
+
+    def do_GET(self):
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if not match or self.server.ignore_ranges:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(FIXTURE)))
+            self.end_headers()
+            self.wfile.write(FIXTURE)
+            return
+        start, end = int(match.group(1)), min(int(match.group(2)), len(FIXTURE) - 1)
+        with self.server.lock:
+            self.server.requests.append((start, end))
+            failing = self.server.failures[start] > 0
+            if failing:
+                self.server.failures[start] -= 1
+        if failing:
+            self.send_error(503)
+            return
+        body = FIXTURE[start:end + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(FIXTURE)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(main.time, "sleep", lambda seconds: None)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.failures = Counter()
+    httpd.ignore_ranges = False
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_port}/video.mp4"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def download(server, filename, **kwargs):
+    progress = []
+    main.ranged_download(server.url, filename, len(FIXTURE), progress.append, connections=3,
+                         chunk_size=CHUNK_SIZE, **kwargs)
+    return sum(progress)
+
+
+def read(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def test_downloads_every_range_in_parallel(server, tmp_path):
+    filename = str(tmp_path / "video.mp4")
+    assert download(server, filename) == len(FIXTURE)
+    assert read(filename) == FIXTURE
+    assert sorted(server.requests) == [(0, 999), (1000, 1999), (2000, 2999), (3000, 3999), (4000, 4499)]
+    assert not os.path.exists(f"{filename}.manifest")
+
+
+def test_failed_chunk_is_retried_on_its_own(server, tmp_path):
+    server.failures[2000] = main.CHUNK_RETRIES - 1
+    filename = str(tmp_path / "video.mp4")
+    assert download(server, filename) == len(FIXTURE)
+    assert read(filename) == FIXTURE
+    requested = Counter(server.requests)
+    assert requested[(2000, 2999)] == main.CHUNK_RETRIES
+    assert all(count == 1 for start_end, count in requested.items() if start_end != (2000, 2999))
+
+
+def test_interrupted_download_resumes_from_the_manifest(server, tmp_path):
+    filename = str(tmp_path / "video.mp4")
+    server.failures[3000] = main.CHUNK_RETRIES
+    with pytest.raises(requests.HTTPError):
+        download(server, filename)
+    with open(f"{filename}.manifest") as f:
+        manifest = json.load(f)
+    assert 3000 not in manifest["completed"]
+    done = set(manifest["completed"])
+
+    server.requests.clear()
+    progress = download(server, filename)
+    assert read(filename) == FIXTURE
+    assert progress == len(FIXTURE)
+    fetched = {start for start, _ in server.requests}
+    assert 3000 in fetched
+    assert not fetched & done
+
+
+def test_stale_manifest_is_ignored(server, tmp_path):
+    filename = str(tmp_path / "video.mp4")
+    with open(filename, "wb") as f:
+        f.write(b"\0" * len(FIXTURE))
+    with open(f"{filename}.manifest", "w") as f:
+        json.dump({"filesize": len(FIXTURE), "chunk_size": CHUNK_SIZE * 2, "completed": [0, 2000]}, f)
+    download(server, filename)
+    assert read(filename) == FIXTURE
+    assert len(server.requests) == 5
+
+
+def stream_through_pipe(server, tmp_path, received):
+    # Reads the pipe the way ffmpeg would, collecting everything written into it
+    fifo_path = str(tmp_path / "video.pipe")
+    os.mkfifo(fifo_path)
+    reader = threading.Thread(target=lambda: received.append(read(fifo_path)), daemon=True)
+    reader.start()
+    try:
+        return main.feed_pipe(server.url, len(FIXTURE), fifo_path, threading.Event())
+    finally:
+        reader.join(timeout=5)
+
+
+def test_pipe_is_fed_in_sequential_ranges(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DOWNLOAD_CHUNK_SIZE", CHUNK_SIZE)
+    received = []
+    assert stream_through_pipe(server, tmp_path, received) == len(FIXTURE)
+    assert received == [FIXTURE]
+    assert server.requests == [(0, 999), (1000, 1999), (2000, 2999), (3000, 3999), (4000, 4499)]
+
+
+def test_pipe_feed_rejects_servers_that_ignore_ranges(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DOWNLOAD_CHUNK_SIZE", CHUNK_SIZE)
+    server.ignore_ranges = True
+    received = []
+    with pytest.raises(IOError, match="ignored range request"):
+        stream_through_pipe(server, tmp_path, received)
+    assert received == [b""]
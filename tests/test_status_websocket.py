@@ -0,0 +1,22 @@
+import time
+
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+def test_idle_watchers_are_dropped_when_the_client_goes_away():
+    main.task_store.add(main.DownloadStatus(task_id="idle-task", status="Queued"))
+    with client.websocket_connect("/status/idle-task/ws"):
+        deadline = time.monotonic() + 2
+        while not main.task_events.watchers.get("idle-task") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(main.task_events.watchers["idle-task"]) == 1
+
+    # No state change follows, so only the disconnect itself can release the watcher
+    deadline = time.monotonic() + 2
+    while "idle-task" in main.task_events.watchers and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert "idle-task" not in main.task_events.watchers
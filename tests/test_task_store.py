@@ -0,0 +1,123 @@
+import time
+
+import main
+
+
+def test_finished_tasks_read_back_from_sqlite(tmp_path):
+    store = main.SQLiteTaskStore(str(tmp_path / "tasks.db"))
+    # Mostly unset fields, as on a task that failed before it picked a stream
+    store.add(main.DownloadStatus(task_id="failed", status="Failed", error="Video unavailable"))
+    store.add(main.DownloadStatus(task_id="done", status="Completed", video_id="aaaaaaaaaaa",
+                                  filename="clip.mp4", cache_key="abc", transcode_percent=100.0))
+    store.add_alias("alias", "done")
+    store.flush()
+    assert store.tasks == {}
+
+    failed = store.get("failed")
+    assert failed.status == "Failed"
+    assert failed.error == "Video unavailable"
+    assert failed.video_id is None
+
+    done = store.get("done")
+    assert (done.status, done.filename, done.transcode_percent) == ("Completed", "clip.mp4", 100.0)
+
+    alias = store.get("alias")
+    assert alias.task_id == "alias"
+    assert alias.filename == "clip.mp4"
+    store.close()
+
+
+def test_running_tasks_stay_in_memory_after_flush(tmp_path):
+    store = main.SQLiteTaskStore(str(tmp_path / "tasks.db"))
+    task = main.DownloadStatus(task_id="running", status="Downloading")
+    store.add(task)
+    store.flush()
+    assert store.get("running") is task
+    store.close()
+
+    reopened = main.SQLiteTaskStore(str(tmp_path / "tasks.db"))
+    assert reopened.get("running").status == "Downloading"
+    reopened.close()
+
+
+def test_tasks_are_found_by_video_id(tmp_path):
+    store = main.SQLiteTaskStore(str(tmp_path / "tasks.db"))
+    store.add(main.DownloadStatus(task_id="old", status="Completed", video_id="aaaaaaaaaaa"))
+    store.add(main.DownloadStatus(task_id="other", status="Completed", video_id="bbbbbbbbbbb"))
+    store.flush()
+    store.add(main.DownloadStatus(task_id="running", status="Downloading", video_id="aaaaaaaaaaa"))
+    assert [task.task_id for task in store.find_by_video_id("aaaaaaaaaaa")] == ["running", "old"]
+    assert [task.task_id for task in store.find_by_video_id("aaaaaaaaaaa", limit=1)] == ["running"]
+    store.close()
+
+
+def test_identical_jobs_on_two_workers_run_once(tmp_path):
+    database = str(tmp_path / "tasks.db")
+    first, second = main.SQLiteTaskStore(database), main.SQLiteTaskStore(database)
+    assert first.claim_inflight("job", "task-1") == "task-1"
+    assert second.claim_inflight("job", "task-2") == "task-1"
+    assert second.inflight_task("job") == "task-1"
+
+    first.add(main.DownloadStatus(task_id="task-1", status="Downloading", subscribers=1))
+    first.flush()
+    assert second.add_alias("task-2", "task-1") == 2
+    first.flush()
+    assert first.get("task-1").subscribers == 2
+    assert second.get("task-2").status == "Downloading"
+
+    first.release_inflight("job", "task-1")
+    assert second.claim_inflight("job", "task-3") == "task-3"
+    first.close()
+    second.close()
+
+
+def test_journaled_jobs_of_a_dead_worker_are_claimed_once(tmp_path, monkeypatch):
+    database = str(tmp_path / "tasks.db")
+    dead, first, second = (main.SQLiteTaskStore(database) for _ in range(3))
+    request = {"url": "https://www.youtube.com/watch?v=aaaaaaaaaaa", "resolution": "720p"}
+    dead.journal_job("orphan", request)
+    dead.claim_inflight("job", "orphan")
+    # Still heartbeating: neither its jobs nor its in-flight keys are up for grabs
+    assert first.claim_orphaned_jobs() == {}
+    assert first.inflight_task("job") == "orphan"
+
+    monkeypatch.setattr(main, "WORKER_TIMEOUT", 0.05)
+    time.sleep(0.1)
+    first.heartbeat()
+    second.heartbeat()
+    assert first.inflight_task("job") is None
+    assert first.claim_orphaned_jobs() == {"orphan": request}
+    assert second.claim_orphaned_jobs() == {}
+    assert second.journaled_task_ids() == {"orphan"}
+    for store in (dead, first, second):
+        store.db.close()
+
+
+def test_closed_workers_hand_their_jobs_back(tmp_path):
+    database = str(tmp_path / "tasks.db")
+    leaving, staying = main.SQLiteTaskStore(database), main.SQLiteTaskStore(database)
+    request = {"url": "https://www.youtube.com/watch?v=aaaaaaaaaaa", "resolution": "720p"}
+    leaving.journal_job("unfinished", request)
+    leaving.close()
+    assert staying.claim_orphaned_jobs() == {"unfinished": request}
+    staying.close()
+
+
+def test_cache_index_is_shared_between_workers(tmp_path):
+    legacy = tmp_path / "index.json"
+    main.write_json_atomic(str(legacy), {"old": {"filename": "a.mp4", "size": 3, "created": 1.0,
+                                                 "last_access": 2.0, "hits": 4}})
+    database = str(tmp_path / "tasks.db")
+    first = main.SQLiteCacheIndex(database, str(legacy))
+    second = main.SQLiteCacheIndex(database, str(legacy))
+    assert second.get("old") == {"filename": "a.mp4", "size": 3, "created": 1.0, "last_access": 2.0, "hits": 4}
+    assert not legacy.exists()
+
+    first.put("package", {"filename": "master.m3u8", "size": 10, "package": "hls", "created": 5.0,
+                          "last_access": 5.0, "hits": 0})
+    second.touch("package")
+    assert first.get("package")["hits"] == 1
+    assert first.usage() == (2, 13)
+    # Only one of two workers evicting the same entry gets to delete its files
+    assert first.remove("old") is True
+    assert second.remove("old") is False